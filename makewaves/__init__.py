@@ -1,5 +1,14 @@
 __version__ = "0.1.3"
 
-from makewaves.main import main
-
 __all__ = ["main"]
+
+
+def __getattr__(name):
+    # Import the GUI lazily so the computational modules and the
+    # makewaves-limits CLI don't need PyQt5 or load the limits at import
+    if name == "main":
+        from makewaves.main import main
+
+        globals()["main"] = main
+        return main
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
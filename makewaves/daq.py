@@ -0,0 +1,398 @@
+"""Analog output hardware abstraction.
+
+``WaveGen`` and the main window talk to the DAQ through an output object
+returned by ``open_output``. The "daqmx" backend drives an NI device. The
+"simulated" backend models the device buffer and sample clock in software,
+so the output loop can be run and soak-tested without hardware. It is the
+default if ``daqmx`` is not installed.
+"""
+
+import time
+
+import numpy as np
+
+try:
+    import daqmx
+except ImportError:
+    daqmx = None
+
+backends = ("daqmx", "simulated")
+default_backend = "daqmx" if daqmx is not None else "simulated"
+
+
+class DAQError(Exception):
+    """Error raised by an analog output, with the DAQmx error code."""
+
+    def __init__(self, message, code=None):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+class UnderrunError(DAQError):
+    """The buffer ran empty and generation stopped."""
+
+
+def check_backend(backend=None):
+    """Returns the backend name, resolving None to ``default_backend``."""
+    if backend is None:
+        backend = default_backend
+    if backend not in backends:
+        raise ValueError("Unknown DAQ backend: " + str(backend))
+    if backend == "daqmx" and daqmx is None:
+        raise DAQError("The daqmx package is not installed")
+    return backend
+
+
+def ao_channels(backend=None):
+    """Returns the analog output physical channels available."""
+    if check_backend(backend) == "simulated":
+        return [SimulatedOutput.channel_name]
+    channels = []
+    for dev in daqmx.GetSysDevNames():
+        channels += [c for c in daqmx.GetDevAOPhysicalChans(dev) if c]
+    return channels
+
+
+def open_output(channel, sr, buffsize, backend=None, **kwargs):
+    """Create a continuous, non-regenerating analog output task on
+    ``channel`` at sample rate ``sr`` with a buffer of ``buffsize`` samples.
+    Keyword arguments are passed to the backend's class."""
+    if check_backend(backend) == "simulated":
+        return SimulatedOutput(channel, sr, buffsize, **kwargs)
+    return DAQmxOutput(channel, sr, buffsize, **kwargs)
+
+
+def plan_blocks(sr, latency, fifo_size=None, max_blocks=4, min_block=0.01):
+    """Choose the write block size for a latency budget.
+
+    About ``latency`` seconds of output are kept in flight, split into
+    between 2 and ``max_blocks`` blocks of at least ``min_block`` seconds
+    where the budget allows, and no larger than the device's onboard FIFO.
+    A larger budget means fewer, larger writes; a smaller one means new data
+    reaches the output sooner. Returns the block size in samples and the
+    number of blocks in flight.
+    """
+    n = max(int(latency * sr), 2)
+    nblocks = n // max(int(min_block * sr), 1)
+    nblocks = min(max(nblocks, 2), max_blocks)
+    block_size = n // nblocks
+    if fifo_size:
+        block_size = min(block_size, fifo_size)
+    return block_size, nblocks
+
+
+class AnalogOutput(object):
+    """Interface of an analog output task.
+
+    Samples written before ``start`` are output first. Once started, the
+    sample clock consumes ``sr`` samples per second from the buffer, and
+    ``write`` waits up to ``timeout`` seconds for space. ``buffer_size`` is
+    the number of samples the buffer holds, ``fifo_size`` the size of the
+    device's onboard FIFO, if known, and ``n_written`` the number written so
+    far.
+    """
+
+    buffer_size = None
+    fifo_size = None
+    n_written = 0
+
+    def write(self, data, timeout=10.0):
+        raise NotImplementedError
+
+    def start(self):
+        raise NotImplementedError
+
+    def write_space(self):
+        """Returns the number of samples that can be written without
+        waiting."""
+        raise NotImplementedError
+
+    def n_generated(self):
+        """Returns the number of samples output since the start."""
+        raise NotImplementedError
+
+    def queued(self):
+        """Returns the number of samples written but not yet output,
+        including those in the device's onboard FIFO."""
+        return self.n_written - self.n_generated()
+
+    def stop(self, timeout=10.0):
+        """Stop the task. Samples not yet output are discarded."""
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class DAQmxOutput(AnalogOutput):
+    """Analog output on an NI device through ``daqmx``.
+
+    If ``daqmx`` does not provide ``GetWriteTotalSampPerChanGenerated``,
+    the samples queued are taken from the buffer space the device reports,
+    plus the onboard FIFO while the host buffer is not empty. Without
+    ``GetBufOutputOnbrdBufSize`` the FIFO size is unknown and left out.
+    """
+
+    def __init__(self, channel, sr, buffsize, vmin=-10.0, vmax=10.0):
+        self.channel = channel
+        self.sr = sr
+        self.handle = daqmx.TaskHandle()
+        daqmx.CreateTask("", self.handle)
+        daqmx.CreateAOVoltageChan(
+            self.handle, channel, "", vmin, vmax, daqmx.Val_Volts, None
+        )
+        daqmx.CfgSampClkTiming(
+            self.handle,
+            "",
+            sr,
+            daqmx.Val_Rising,
+            daqmx.Val_ContSamps,
+            buffsize,
+        )
+        daqmx.SetWriteRegenMode(self.handle, daqmx.Val_DoNotAllowRegen)
+        # Nothing has been written yet, so all of the buffer is free
+        self.buffer_size = daqmx.GetWriteSpaceAvail(self.handle)
+        get_fifo_size = getattr(daqmx, "GetBufOutputOnbrdBufSize", None)
+        if get_fifo_size is not None:
+            self.fifo_size = get_fifo_size(self.handle)
+        self.n_written = 0
+        self._get_generated = getattr(
+            daqmx, "GetWriteTotalSampPerChanGenerated", None
+        )
+
+    def write(self, data, timeout=10.0):
+        daqmx.WriteAnalogF64(
+            self.handle,
+            len(data),
+            False,
+            timeout,
+            daqmx.Val_GroupByChannel,
+            data,
+        )
+        self.n_written += len(data)
+
+    def start(self):
+        daqmx.StartTask(self.handle)
+
+    def n_generated(self):
+        if self._get_generated is not None:
+            return self._get_generated(self.handle)
+        return self.n_written - self.queued()
+
+    def queued(self):
+        if self._get_generated is not None:
+            return AnalogOutput.queued(self)
+        # Use the buffer state the device reports rather than the host clock,
+        # which drifts from the sample clock
+        queued = self.buffer_size - self.write_space()
+        if queued > 0 and self.fifo_size:
+            # The device keeps its FIFO full while the host buffer has data
+            queued += self.fifo_size
+        return queued
+
+    def write_space(self):
+        return daqmx.GetWriteSpaceAvail(self.handle)
+
+    def stop(self, timeout=10.0):
+        daqmx.StopTask(self.handle)
+        daqmx.WaitUntilTaskDone(self.handle, timeout=timeout)
+
+    def clear(self):
+        daqmx.ClearTask(self.handle)
+
+
+class SimulatedOutput(AnalogOutput):
+    """Software model of a non-regenerating analog output.
+
+    Written samples queue in a host buffer of ``buffsize`` samples, from
+    which the device keeps its onboard FIFO of ``fifo_size`` samples full.
+    Once started, the sample clock consumes ``sr`` samples per second of
+    ``clock`` time. If the queue runs empty the task stops with an
+    ``UnderrunError``, raised by the next call, as DAQmx does.
+
+    ``min_queued`` is the fewest samples that were queued at any write
+    after the start, i.e. the underrun margin, and ``max_latency`` the
+    longest time in seconds between writing a sample and its output. If
+    ``record`` is True, written blocks are kept in ``written``. Faults can
+    be injected with ``inject``, or given up front as ``faults``, a sequence
+    of its argument tuples.
+    """
+
+    channel_name = "Sim1/ao0"
+
+    def __init__(
+        self,
+        channel,
+        sr,
+        buffsize,
+        fifo_size=8191,
+        clock=time.monotonic,
+        sleep=time.sleep,
+        record=False,
+        faults=(),
+    ):
+        self.channel = channel
+        self.sr = sr
+        self.buffer_size = int(buffsize)
+        self.fifo_size = fifo_size
+        self.clock = clock
+        self._sleep = sleep
+        self.record = record
+        self.written = []
+        self.faults = []
+        self.t_start = None
+        self.n_written = 0
+        self.n_writes = 0
+        self.min_queued = None
+        self.max_latency = 0.0
+        self.error = None
+        self.cleared = False
+        for fault in faults:
+            self.inject(*fault)
+
+    def inject(self, method, error=None, after=0, delay=0.0):
+        """Make the call to ``method`` ("write", "write_space", "start" or
+        "stop") after the next ``after`` calls wait ``delay`` seconds, then
+        raise ``error`` if it is not None."""
+        self.faults.append([method, after, error, delay])
+
+    def _fault(self, method):
+        for fault in self.faults:
+            if fault[0] != method:
+                continue
+            if fault[1] > 0:
+                fault[1] -= 1
+                continue
+            self.faults.remove(fault)
+            if fault[3]:
+                self._sleep(fault[3])
+            if fault[2] is not None:
+                raise fault[2]
+            return
+
+    def n_generated(self):
+        if self.t_start is None:
+            return 0
+        n = int((self.clock() - self.t_start) * self.sr)
+        return min(n, self.n_written)
+
+    def queued(self):
+        self._check()
+        return self.n_written - self.n_generated()
+
+    def _check(self):
+        if self.cleared:
+            raise DAQError("Task has been cleared", code=-200088)
+        if self.error is None and self.t_start is not None:
+            # Samples are due up to the current time; if fewer were written,
+            # the clock ran past the end of the queue
+            due = int((self.clock() - self.t_start) * self.sr)
+            if due > self.n_written:
+                self.error = UnderrunError(
+                    "Underrun after {} samples ({:.3f} s): the generation "
+                    "has stopped to prevent the regeneration of old "
+                    "samples".format(self.n_written, self.n_written / self.sr),
+                    code=-200290,
+                )
+        if self.error is not None:
+            raise self.error
+
+    def write_space(self):
+        self._fault("write_space")
+        queued = self.queued()
+        return max(0, self.buffer_size - max(0, queued - self.fifo_size))
+
+    def write(self, data, timeout=10.0):
+        self._fault("write")
+        n = len(data)
+        if n > self.buffer_size:
+            raise DAQError(
+                "Cannot write {} samples to a buffer of {}".format(
+                    n, self.buffer_size
+                ),
+                code=-200547,
+            )
+        if self.t_start is not None:
+            queued = self.queued()
+            if self.min_queued is None or queued < self.min_queued:
+                self.min_queued = queued
+        t_end = self.clock() + timeout
+        while self.write_space() < n:
+            if self.t_start is None or self.clock() >= t_end:
+                raise DAQError(
+                    "Timed out waiting for space to write {} samples".format(
+                        n
+                    ),
+                    code=-200292,
+                )
+            wait = (n - self.write_space()) / self.sr
+            self._sleep(min(wait, max(t_end - self.clock(), 0.0)))
+        if self.t_start is not None:
+            latency = (self.queued() + n) / self.sr
+            self.max_latency = max(self.max_latency, latency)
+        if self.record:
+            self.written.append(np.array(data, dtype=float))
+        self.n_written += n
+        self.n_writes += 1
+
+    def start(self):
+        self._fault("start")
+        self._check()
+        if self.n_written == 0:
+            raise DAQError("No samples written before start", code=-200462)
+        self.t_start = self.clock()
+
+    def stop(self, timeout=10.0):
+        self._fault("stop")
+        self._check()
+        self.t_start = None
+
+    def clear(self):
+        self.cleared = True
+
+    def output(self):
+        """Returns all recorded samples as one array."""
+        if not self.written:
+            return np.zeros(0)
+        return np.concatenate(self.written)
+
+
+class WriteScheduler(object):
+    """Paces writes to an analog output by its buffer state.
+
+    ``wait`` polls the number of samples queued and sleeps until it has
+    drained to ``fill_target`` seconds of output, so each write tops the
+    queue back up. Sleeps are computed from the queue level and the sample
+    rate, not from elapsed time, and last at most ``max_sleep`` seconds.
+    ``min_queued`` is the fewest samples seen queued after waiting for the
+    fill target, i.e. the underrun margin the writer actually kept.
+    """
+
+    def __init__(
+        self, output, fill_target=0.5, max_sleep=0.1, sleep=time.sleep
+    ):
+        self.output = output
+        self.fill_target = fill_target
+        self.max_sleep = max_sleep
+        self._sleep = sleep
+        self.min_queued = None
+
+    def target(self):
+        """Returns the fill target in samples."""
+        return int(round(self.fill_target * self.output.sr))
+
+    def wait(self, level=None):
+        """Sleep until at most ``level`` samples are queued, by default the
+        fill target. Returns the number queued."""
+        track = level is None
+        if track:
+            level = self.target()
+        while True:
+            queued = self.output.queued()
+            excess = queued - level
+            if excess <= 0:
+                break
+            self._sleep(min(excess / self.output.sr, self.max_sleep))
+        if track and (self.min_queued is None or queued < self.min_queued):
+            self.min_queued = queued
+        return queued
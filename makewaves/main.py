@@ -6,7 +6,6 @@ import platform
 import sys
 import time
 
-import daqmx
 import numpy as np
 import qwt as Qwt
 from PyQt5 import QtCore, QtGui, QtWidgets, uic
@@ -25,28 +24,19 @@ from PyQt5.QtWidgets import (
 
 import makewaves.wavemakerlimits as wml
 
+from . import daq
 from .mainwindow import *
 from .waveio import WaveGen
-from .wavetsgen import Wave
+from .wavetsgen import Wave, spectra
 
 _thisdir = os.path.dirname(os.path.abspath(__file__))
 settings_dir = os.path.join(_thisdir, "settings")
 
-# Spectral parameters for random waves
-bret_params = [
-    ("Significant Wave Height", 0.1),
-    ("Significant Wave Period", 1.0),
-    ("Scale Ratio", 1.0),
-]
-
-jonswap_params = [
-    ("Significant Wave Height", 0.1),
-    ("Significant Wave Period", 1.0),
-    ("Scale Ratio", 1.0),
-    ("Gamma", 3.3),
-    ("Sigma A", 0.07),
-    ("Sigma B", 0.09),
-]
+# Spectral parameters for random waves, as (label, default) pairs
+rw_params = {
+    name: [(label, default) for attr, label, default in spectrum.parameters]
+    for name, spectrum in spectra.items()
+}
 
 nhextreme_params = [
     ("Significant Wave Height", 6.58),
@@ -68,31 +58,15 @@ nhtypical_params = [
     ("P", 4.34),
 ]
 
-pm_params = [("Wind Speed", 2.0), ("Scale Ratio", 1.0)]
-
-rw_params = {
-    "Bretschneider": bret_params,
-    "JONSWAP": jonswap_params,
-    "Pierson-Moskowitz": pm_params,
-}
-
 # Some universal constants
 paddle_height = 1.0
 water_depth = 2.44
 minperiod = 0.5
 maxperiod = 5.0
 
-# See if limits data exist and generate is need be
-periods_fpath = os.path.join(settings_dir, "periods.npy")
-maxh_fpath = os.path.join(settings_dir, "maxH.npy")
-if not os.path.isfile(periods_fpath) or not os.path.isfile(maxh_fpath):
-    print("No wavemaker limit settings found")
-    wml.findlimits()
-
-periods = np.round(np.load(periods_fpath), decimals=4)
-maxH = np.load(maxh_fpath)
-minL = 2 * np.pi / wml.dispsolver(2 * np.pi / 0.65, water_depth, decimals=2)
-maxL = 2 * np.pi / wml.dispsolver(2 * np.pi / 4.50, water_depth, decimals=2)
+# Load max wave height over periods and depths, which is recomputed if any
+# tank constant changed
+limits_surface = wml.load_limits_surface()
 
 # Constants specific to rand waves
 minperiod_rand = 0.90
@@ -111,11 +85,8 @@ class MainWindow(QMainWindow):
         self.calcthread = None
 
         # Initialize AO physical channel
-        devices = daqmx.GetSysDevNames()
-        print("Found system devices:", devices)
-        phys_chans = []
-        for dev in devices:
-            phys_chans += [c for c in daqmx.GetDevAOPhysicalChans(dev) if c]
+        print("DAQ backend:", daq.default_backend)
+        phys_chans = daq.ao_channels()
         self.ao_physical_channels = phys_chans
         print("Detected AO physical channels:", phys_chans)
         self.ao_physical_channel = self.ao_physical_channels[0]
@@ -137,6 +108,13 @@ class MainWindow(QMainWindow):
         chans_action_group.setExclusive(True)
         chans_action_group.triggered.connect(self.on_ao_changed)
 
+        # Add water depth setting
+        self.action_water_depth = QAction(
+            "Water depth...", self.ui.menuOptions
+        )
+        self.ui.menuOptions.addAction(self.action_water_depth)
+        self.action_water_depth.triggered.connect(self.on_water_depth)
+
         # Add a label to the status bar
         self.slabel = QLabel()
         self.ui.statusbar.addWidget(self.slabel)
@@ -149,6 +127,22 @@ class MainWindow(QMainWindow):
         # Set up a control variable for parameters
         self.parameters = "HT"
 
+        # One random wave per spectrum, shared by the check and output and
+        # updated as parameters change, so only the stages an edit affects
+        # are recomputed and the streamed series that was checked is the one
+        # that gets generated. Only the first wavetsgen.check_duration
+        # seconds are checked; WaveGen stops at the stroke limit if it is
+        # reached later
+        self.rw_seed = np.random.SeedSequence().entropy
+        self.rw_waves = {}
+        self.rw_recheck = False
+
+        # List registered random wave spectra
+        self.ui.combobox_randwavetype.blockSignals(True)
+        self.ui.combobox_randwavetype.clear()
+        self.ui.combobox_randwavetype.addItems(list(spectra))
+        self.ui.combobox_randwavetype.blockSignals(False)
+
         # Set default tab to regular waves
         self.ui.tabwidget.setCurrentIndex(0)
 
@@ -156,17 +150,13 @@ class MainWindow(QMainWindow):
         self.connectslots()
 
         # Initialize slider values
-        hmax = maxH[np.where(periods == np.round(1, decimals=2))[0]]
-        self.ui.spinbox_wave_height.setMaximum(float(hmax))
+        hmax = self.limits.max_height(1.0)
+        self.ui.spinbox_wave_height.setMaximum(hmax)
         self.ui.spinbox_wave_height.setValue(0.1)
         self.update_slider_height_value()
 
         # Initialize wavelength value
-        wl = (
-            2
-            * np.pi
-            / wml.dispsolver(2 * np.pi / 1.0, water_depth, decimals=2)
-        )
+        wl = wml.period_to_wavelength(1.0, self.water_depth)
         self.ui.spinbox_wavelength.setValue(wl)
         self.ui.spinbox_wave_period.setValue(1.0)
         self.update_slider_horiz_value()
@@ -186,6 +176,7 @@ class MainWindow(QMainWindow):
                 self.settings = json.load(fn)
         except IOError:
             self.settings = {}
+        self.set_water_depth(self.settings.get("Water depth", water_depth))
         if "Last PC name" in self.settings:
             if self.settings["Last PC name"] == self.pcid:
                 if "Last window location" in self.settings:
@@ -202,6 +193,14 @@ class MainWindow(QMainWindow):
                 ):
                     self.ao_physical_channel = ao_phys_chan
 
+    def set_water_depth(self, depth):
+        """Sets the operating water depth and its wave height limits."""
+        self.water_depth = depth
+        periods, maxH = limits_surface.curve(depth)
+        self.limits = wml.LimitsIndex(periods, maxH, depth=depth)
+        self.minL = wml.period_to_wavelength(0.65, depth)
+        self.maxL = wml.period_to_wavelength(4.50, depth)
+
     def setup_spinboxes(self, nboxes):
         """Add double spin boxes to the random waves table widget"""
         self.spinboxes_rw = []
@@ -294,6 +293,24 @@ class MainWindow(QMainWindow):
     def on_ao_changed(self, action):
         self.ao_physical_channel = action.text()
 
+    def on_water_depth(self):
+        depth, ok = QInputDialog.getDouble(
+            self,
+            "Water depth",
+            "Water depth (m):",
+            self.water_depth,
+            wml.min_depth,
+            wml.max_depth,
+            2,
+        )
+        if ok:
+            self.set_water_depth(depth)
+            if self.parameters == "HL":
+                self.ui.spinbox_wavelength.setMaximum(self.maxL)
+                self.ui.spinbox_wavelength.setMinimum(self.minL)
+            self.on_wp_changed()
+            self.on_wl_changed()
+
     def on_wh_changed(self):
         # Need some way to let user continue typing before changing slider
         self.update_slider_height_value()
@@ -301,27 +318,19 @@ class MainWindow(QMainWindow):
     def on_wp_changed(self):
         wp = self.ui.spinbox_wave_period.value()
         if self.parameters == "HT":
-            hmax = maxH[np.where(periods == np.round(wp, decimals=2))[0][0]]
+            hmax = self.limits.max_height(wp)
             self.ui.spinbox_wave_height.setMaximum(hmax)
             self.update_slider_height_value()
-            wl = (
-                2
-                * np.pi
-                / wml.dispsolver(2 * np.pi / wp, water_depth, decimals=1)
-            )
+            wl = wml.period_to_wavelength(wp, self.water_depth)
             self.ui.spinbox_wavelength.setValue(wl)
             self.update_slider_horiz_value()
 
     def on_wl_changed(self):
         if self.parameters == "HL":
             wl = self.ui.spinbox_wavelength.value()
-            wp = (
-                2
-                * np.pi
-                / wml.revdispsolver(2 * np.pi / wl, water_depth, decimals=2)
-            )
+            wp = wml.wavelength_to_period(wl, self.water_depth)
             self.ui.spinbox_wave_period.setValue(wp)
-            hmax = maxH[np.where(periods == np.round(wp, decimals=2))[0][0]]
+            hmax = self.limits.max_height(wp)
             self.ui.spinbox_wave_height.setMaximum(hmax)
             self.update_slider_horiz_value()
 
@@ -370,11 +379,7 @@ class MainWindow(QMainWindow):
         if self.ui.combobox_regparams.currentIndex() == 0:
             self.parameters = "HT"
             wl = self.ui.spinbox_wavelength.value()
-            wp = (
-                2
-                * np.pi
-                / wml.revdispsolver(2 * np.pi / wl, water_depth, decimals=1)
-            )
+            wp = wml.wavelength_to_period(wl, self.water_depth)
             self.ui.spinbox_wave_period.setEnabled(True)
             self.ui.spinbox_wavelength.setDisabled(True)
             self.ui.spinbox_wavelength.setMinimum(0)
@@ -387,15 +392,11 @@ class MainWindow(QMainWindow):
         elif self.ui.combobox_regparams.currentIndex() == 1:
             self.parameters = "HL"
             wp = self.ui.spinbox_wave_period.value()
-            wl = (
-                2
-                * np.pi
-                / wml.dispsolver(2 * np.pi / wp, water_depth, decimals=1)
-            )
+            wl = wml.period_to_wavelength(wp, self.water_depth)
             self.ui.spinbox_wave_period.setEnabled(False)
             self.ui.spinbox_wavelength.setDisabled(False)
-            self.ui.spinbox_wavelength.setMaximum(maxL)
-            self.ui.spinbox_wavelength.setMinimum(minL)
+            self.ui.spinbox_wavelength.setMaximum(self.maxL)
+            self.ui.spinbox_wavelength.setMinimum(self.minL)
             self.update_slider_horiz_value()
 
     def on_rw_changed(self):
@@ -420,21 +421,40 @@ class MainWindow(QMainWindow):
         for sb in self.spinboxes_rw:
             sb.valueChanged.connect(self.on_rw_param_changed)
 
+    def set_rw_params(self, wave):
+        """Sets a random wave's spectral parameters from the table."""
+        for (attr, label, default), sb in zip(
+            spectra[wave.wavetype].parameters, self.spinboxes_rw
+        ):
+            setattr(wave, attr, sb.value())
+
+    def rw_wave(self):
+        """Returns the random wave of the selected spectrum, updated from
+        the table and the water depth."""
+        rwtype = self.ui.combobox_randwavetype.currentText()
+        if rwtype not in self.rw_waves:
+            self.rw_waves[rwtype] = Wave(rwtype, seed=self.rw_seed)
+        wave = self.rw_waves[rwtype]
+        wave.water_depth = self.water_depth
+        self.set_rw_params(wave)
+        return wave
+
     def on_rw_param_changed(self):
         """If a random wave parameter is changed, start a thread to check
         if the parameters don't over-extend the piston."""
-        rwtype = self.ui.combobox_randwavetype.currentText()
-        wave = Wave(rwtype)
-        if rwtype == "Bretschneider" or rwtype == "JONSWAP":
-            wave.sig_height = self.spinboxes_rw[0].value()
-            wave.sig_period = self.spinboxes_rw[1].value()
-            wave.scale_ratio = self.spinboxes_rw[2].value()
-        elif rwtype == "Pierson-Moskowitz":
-            wave.windspeed = self.spinboxes_rw[0].value()
-            wave.scale_ratio = self.spinboxes_rw[1].value()
-        if not self.calcthread or not self.calcthread.isRunning():
-            self.calcthread = CalcThread(self, wave)
-            self.calcthread.start()
+        if self.calcthread is not None and self.calcthread.isRunning():
+            # Leave the wave alone while it is checked and check it again
+            # with the new parameters afterwards
+            self.rw_recheck = True
+            return
+        self.calcthread = CalcThread(self, self.rw_wave())
+        self.calcthread.finished.connect(self.on_rw_checked)
+        self.calcthread.start()
+
+    def on_rw_checked(self):
+        if self.rw_recheck:
+            self.rw_recheck = False
+            self.on_rw_param_changed()
 
     def on_start(self):
         """Make waves."""
@@ -452,28 +472,36 @@ class MainWindow(QMainWindow):
                 self.wavegen = WaveGen(
                     "Regular", ao_physical_channel=self.ao_physical_channel
                 )
+                self.wavegen.wave.water_depth = self.water_depth
                 self.wavegen.wave.period = self.period
                 self.wavegen.wave.height = self.height
+                self.wavegen.failed.connect(self.on_wave_failed)
                 self.wavegen.start()
 
             elif wavetype == 1:
                 # Create random waves
                 rspec = self.ui.combobox_randwavetype.currentText()
-                self.slabel.setText("Generating " + rspec + " waves... ")
+                self.slabel.setText(
+                    "Generating {} waves (seed {})... ".format(
+                        rspec, self.rw_seed
+                    )
+                )
+                # Keep the seed with the run, so it can be regenerated
+                self.settings["Last random wave run"] = {
+                    "Type": rspec,
+                    "Seed": self.rw_seed,
+                    "Time": time.strftime("%Y-%m-%d %H:%M:%S"),
+                }
+                self.save_settings()
+                if self.calcthread is not None:
+                    # Don't update the wave while it is being checked
+                    self.calcthread.wait()
                 self.wavegen = WaveGen(
-                    rspec, ao_physical_channel=self.ao_physical_channel
+                    rspec,
+                    ao_physical_channel=self.ao_physical_channel,
+                    wave=self.rw_wave(),
                 )
-                if rspec == "Bretschneider" or rspec == "JONSWAP":
-                    self.wavegen.wave.sig_height = self.spinboxes_rw[0].value()
-                    self.wavegen.wave.sig_period = self.spinboxes_rw[1].value()
-                    self.wavegen.wave.scale_ratio = self.spinboxes_rw[
-                        2
-                    ].value()
-                elif rspec == "Pierson-Moskowitz":
-                    self.wavegen.wave.windspeed = self.spinboxes_rw[0].value()
-                    self.wavegen.wave.scale_ratio = self.spinboxes_rw[
-                        1
-                    ].value()
+                self.wavegen.failed.connect(self.on_wave_failed)
                 self.wavegen.start()
             self.timer.start(500)
         elif self.ui.action_start.isChecked() == False:
@@ -493,6 +521,14 @@ class MainWindow(QMainWindow):
         self.ui.action_start.setEnabled(True)
         self.ui.tabwidget.setEnabled(True)
 
+    def on_wave_failed(self, message):
+        """Reset the controls if output stopped on its own, e.g. at the
+        stroke limit, and show why."""
+        self.ui.action_start.setChecked(False)
+        self.on_wave_finished()
+        self.slabel.setText("Stopped: " + message + " ")
+        QMessageBox.warning(self, "Output stopped", message)
+
     def on_about(self):
         from makewaves import __version__
 
@@ -536,6 +572,11 @@ class MainWindow(QMainWindow):
         ]
         self.settings["Last PC name"] = self.pcid
         self.settings["AO physical channel"] = self.ao_physical_channel
+        self.settings["Water depth"] = self.water_depth
+        self.save_settings()
+
+    def save_settings(self):
+        """Saves settings"""
         with open(os.path.join(settings_dir, "app.json"), "w") as fn:
             json.dump(self.settings, fn, indent=4)
 
@@ -547,8 +588,9 @@ class CalcThread(QThread):
         self.wave = wave
 
     def run(self):
-        self.wave.gen_ts_stroke()
-        if self.wave.ts_stroke.max() > wml.max_halfstroke:
+        # Check the series that is actually played; only a scalar multiply
+        # when just the height changed
+        if self.wave.max_stream_stroke() > wml.max_halfstroke:
             self.mw.ui.action_start.setDisabled(True)
         else:
             self.mw.ui.action_start.setEnabled(True)
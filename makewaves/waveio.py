@@ -3,177 +3,543 @@
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 
-from .wavetsgen import Wave, ramp_ts
+from . import daq
+from .wavemakerlimits import max_halfstroke
+from .wavetsgen import (
+    Wave,
+    close_library_case,
+    load_library_case,
+    load_ts_files,
+    ramp_ts,
+    stream_ts,
+)
+import gc
+import itertools
+import threading
 import time
-import daqmx
 import numpy as np
 
 
+def iter_blocks(ts, block_size, nramp=None):
+    """Yield contiguous blocks of a (memory-mapped) time series.
+
+    The last block may be shorter than ``block_size``. The last ``nramp``
+    samples, by default one block, are ramped down so output ends smoothly
+    when the series runs out.
+    """
+    n = len(ts)
+    if nramp is None:
+        nramp = block_size
+    nramp = min(nramp, n)
+    ramp = ramp_ts(np.ones(nramp), "down")
+    for start in range(0, n, block_size):
+        stop = min(start + block_size, n)
+        block = np.array(ts[start:stop])
+        if stop > n - nramp:
+            i = max(start, n - nramp)
+            block[i - start :] *= ramp[i - (n - nramp) : stop - (n - nramp)]
+        yield block
+
+
+def iter_periodic(ts, block_size):
+    """Yield blocks of ``block_size`` samples of a periodic time series of
+    any length, repeated indefinitely. Blocks are views of one tiled copy
+    of the series, so no arrays are allocated per block."""
+    n = len(ts)
+    tiled = np.tile(ts, -(-(n + block_size) // n))
+    start = 0
+    while True:
+        yield tiled[start : start + block_size]
+        start = (start + block_size) % n
+
+
+def take(stream, n):
+    """Returns the next ``n`` samples of a stream of blocks, or fewer if it
+    ends, and a stream of the samples after them."""
+    blocks = []
+    count = 0
+    for block in stream:
+        blocks.append(block)
+        count += len(block)
+        if count >= n:
+            break
+    if not blocks:
+        return np.zeros(0), stream
+    ts = np.concatenate(blocks)
+    rest = ts[n:]
+    if len(rest):
+        stream = itertools.chain([rest], stream)
+    return ts[:n], stream
+
+
+def ramp_up_blocks(stream, nramp):
+    """Yield the blocks of a stream with its first ``nramp`` samples ramped
+    up."""
+    ramp = ramp_ts(np.ones(nramp), "up")
+    pos = 0
+    for block in stream:
+        n = min(len(block), nramp - pos)
+        block = np.array(block)
+        block[:n] *= ramp[pos : pos + n]
+        pos += n
+        yield block
+        if pos >= nramp:
+            break
+    # Not "yield from", which would close the stream along with this
+    # generator, and the writer continues from it for the rampdown
+    for block in stream:
+        yield block
+
+
+class StrokeLimitError(ValueError):
+    """The output would exceed the wavemaker's stroke limit."""
+
+
+class BlockRing(object):
+    """Bounded ring buffer of blocks between a producer thread and the DAQ
+    writer.
+
+    Blocks are copied into ``nslots`` preallocated contiguous slots of
+    ``block_size`` samples. The producer calls ``reserve`` to wait for a
+    free slot, which is the backpressure on synthesis, then ``put`` or, at
+    the end of the data, ``finish``. ``ready`` is set once ``prefill``
+    blocks are in. The writer calls ``get`` for the oldest block, which
+    returns None at the end of the data, and ``release`` once it is
+    written. Each time ``get`` finds the ring empty it counts an underrun
+    in ``underruns`` and adds the time waited to ``underrun_time``.
+    """
+
+    def __init__(self, nslots, block_size, prefill=1):
+        self.slots = np.zeros((nslots, block_size))
+        self._views = list(self.slots)
+        self.lengths = [0] * nslots
+        self.free = threading.Semaphore(nslots)
+        self.filled = threading.Semaphore(0)
+        self.ready = threading.Event()
+        self.prefill = prefill
+        self.head = 0  # Next slot to fill, used by the producer only
+        self.tail = 0  # Next slot to read, used by the writer only
+        self.produced = 0
+        self.closed = False
+        self.error = None
+        self.underruns = 0
+        self.underrun_time = 0.0
+
+    def reserve(self):
+        """Wait for a free slot. Returns False if the ring was closed."""
+        self.free.acquire()
+        return not self.closed
+
+    def put(self, block):
+        """Copy a block into the reserved slot."""
+        n = len(block)
+        self.slots[self.head, :n] = block
+        self.lengths[self.head] = n
+        self._advance()
+
+    def finish(self):
+        """Mark the end of the data in the reserved slot."""
+        self.lengths[self.head] = 0
+        self._advance()
+        self.ready.set()
+
+    def _advance(self):
+        self.head = (self.head + 1) % len(self.slots)
+        self.produced += 1
+        if self.produced >= self.prefill:
+            self.ready.set()
+        self.filled.release()
+
+    def get(self):
+        """Returns the oldest block, waiting if there is none."""
+        if not self.filled.acquire(blocking=False):
+            self.underruns += 1
+            t0 = time.perf_counter()
+            self.filled.acquire()
+            self.underrun_time += time.perf_counter() - t0
+        n = self.lengths[self.tail]
+        if n == 0:
+            # Leave the end marker in place
+            self.filled.release()
+            return None
+        if n == len(self._views[self.tail]):
+            return self._views[self.tail]
+        return self._views[self.tail][:n]
+
+    def release(self):
+        """Free the slot of the block returned by ``get``."""
+        self.tail = (self.tail + 1) % len(self.slots)
+        self.free.release()
+
+    def close(self):
+        """Stop the producer at its next ``reserve``."""
+        self.closed = True
+        self.free.release()
+
+    def drain(self):
+        """Returns copies of the blocks left in the ring, oldest first. Call
+        once the producer has stopped."""
+        blocks = []
+        while self.filled.acquire(blocking=False):
+            n = self.lengths[self.tail]
+            if n == 0:
+                break
+            blocks.append(self.slots[self.tail, :n].copy())
+            self.tail = (self.tail + 1) % len(self.slots)
+        return blocks
+
+
+class EventLog(object):
+    """Fixed-size in-memory log of output events.
+
+    Entries are stored in preallocated arrays by a single writing thread,
+    without locks or console output, overwriting the oldest when full.
+    ``count`` only ever increases, so other threads can read the entries
+    written before it. Only events out of the ordinary are logged, not
+    every write, and ``counts`` keeps the number of each event since the
+    start even once its entries have been overwritten.
+    """
+
+    names = (
+        "start",
+        "overrun",
+        "underrun",
+        "end",
+        "rampdown",
+        "stop",
+    )
+
+    def __init__(self, size=4096):
+        self.times = np.zeros(size)
+        self.codes = np.zeros(size, dtype=np.int8)
+        self.values = np.zeros(size)
+        self.count = 0
+        self.counts = np.zeros(len(self.names), dtype=np.int64)
+        self._codes = {name: i for i, name in enumerate(self.names)}
+
+    def add(self, name, value=0.0):
+        """Log event ``name``, one of ``names``, with a value."""
+        i = self.count % len(self.times)
+        code = self._codes[name]
+        self.times[i] = time.perf_counter()
+        self.codes[i] = code
+        self.values[i] = value
+        self.counts[code] += 1
+        self.count += 1
+
+    def total(self, name):
+        """Returns the number of times event ``name`` was logged."""
+        return int(self.counts[self._codes[name]])
+
+    def entries(self):
+        """Returns the logged (time, name, value) tuples, oldest first."""
+        count = self.count
+        size = len(self.times)
+        idx = np.arange(max(count - size, 0), count) % size
+        return [
+            (
+                float(self.times[i]),
+                self.names[self.codes[i]],
+                float(self.values[i]),
+            )
+            for i in idx
+        ]
+
+
 class WaveGen(QThread):
-    def __init__(self, wavetype, ao_physical_channel="Dev1/ao0"):
+    # Emitted with the reason when output stops on its own, e.g. at the
+    # stroke limit, which is also kept in ``error``
+    failed = pyqtSignal(str)
+
+    def __init__(
+        self,
+        wavetype,
+        ao_physical_channel="Dev1/ao0",
+        seed=None,
+        ts_path=None,
+        case=None,
+        backend=None,
+        latency=1.0,
+        output_kwargs=None,
+        wave=None,
+    ):
+        """Generates waves of ``wavetype``. If ``wave`` is given, that Wave
+        is played, reusing its cached pipeline stages, and ``wavetype`` and
+        ``seed`` are taken from it. If ``ts_path`` is given, the
+        volt series saved there by ``wavetsgen.gen_ts_files`` is played back
+        instead, and ``wavetype`` and ``seed`` are taken from it. If
+        ``case`` is also given, ``ts_path`` is an HDF5 waveform library
+        built by ``wavetsgen.build_library`` and that case is played.
+        ``backend`` is the ``daq`` backend to output through, and
+        ``output_kwargs`` are passed on to ``daq.open_output``, e.g.
+        ``fifo_size``, ``record`` or ``faults`` for the simulated backend.
+        The output is kept in ``output`` for inspection after a run. About
+        ``latency`` seconds of output are kept queued, written in blocks
+        sized by ``daq.plan_blocks``."""
         QThread.__init__(self)
+        self.ts_path = ts_path
+        self.case = case
+        if ts_path is not None:
+            if case is not None:
+                self.wave, self.ts_files = load_library_case(ts_path, case)
+            else:
+                self.wave, self.ts_files = load_ts_files(ts_path)
+            wavetype = self.wave.wavetype
+        elif wave is not None:
+            self.wave = wave
+            wavetype = wave.wavetype
+        else:
+            self.wave = Wave(wavetype, seed=seed)
         self.wavetype = wavetype
-        self.wave = Wave(self.wavetype)
         self.enable = True
         self.ao_physical_channel = ao_physical_channel
+        self.backend = backend
+        self.latency = latency
+        self.output_kwargs = output_kwargs or {}
 
     def run(self):
         self.rampeddown = False
         self.cleared = False
         self.making = False
+        self.error = None
+        self.output = None
+        self.ring = None
+        self.producer = None
+        self.log = EventLog()
 
-        # Compute the voltage time series associated with the wave
-        self.wave.gen_ts_volts()
+        # Exceptions must not escape a QThread's run. Whatever happens, stop
+        # the producer and the task and let WaveStop finish, then report the
+        # error that ended output
+        try:
+            self.write_output(self.setup())
+            # The producer ends the data at the stroke limit or on an error
+            self.error = self.ring.error
+        except Exception as e:
+            self.error = e
+        finally:
+            self.cleanup()
+        if self.error is not None:
+            print("Output stopped:", self.error)
+            self.failed.emit(str(self.error))
 
-        # Get parameters from the wave object
-        self.period = self.wave.period
-        self.height = self.wave.height
-        self.buffsize = self.wave.sbuffsize
+    def setup(self):
+        """Compute the wave, open the output and start the producer.
+        Returns the number of blocks to keep in flight."""
+        if self.wavetype == "Regular":
+            # Compute the voltage time series associated with the wave
+            self.wave.gen_ts_volts()
+            self.ts_plot = self.wave.ts_elev
+            self.outf, self.outspec = self.wave.comp_spec()
+            volts = self.wave.ts_volts
+            print(
+                "Computed wave with min/max (V): "
+                f"{volts.min():.2f}, {volts.max():.2f}"
+            )
         self.sr = self.wave.sr
+        # Ramps last one wave period for regular waves and 1 s otherwise
+        self.nramp = self.wave.sbuffsize
+        nplot = int(120 * self.sr)
 
-        # Get data to write from the wave object
-        self.ts_plot = self.wave.ts_elev
-        self.dataw = self.wave.ts_volts
+        # The buffer holds the latency budget plus the ramps written on top
+        # of it during rampdown
+        self.output = daq.open_output(
+            self.ao_physical_channel,
+            self.sr,
+            int(np.ceil(self.latency * self.sr)) + 2 * self.nramp,
+            self.backend,
+            **self.output_kwargs,
+        )
+        self.buffsize, nblocks = daq.plan_blocks(
+            self.sr, self.latency, self.output.fifo_size
+        )
+        self.scheduler = daq.WriteScheduler(
+            self.output, (nblocks - 1) * self.buffsize / self.sr
+        )
         print(
-            "Computed wave with min/max (V): "
-            f"{min(self.dataw):.2f}, {max(self.dataw):.2f}"
+            f"Writing blocks of {self.buffsize} samples, {nblocks} in flight"
         )
 
-        # If random waves, divide up time series into 120 256 sample parts
-        if self.wavetype != "Regular":
-            tsparts = np.reshape(self.dataw, (120, 256))
-            self.dataw = tsparts[0, :]
-
-        # Compute spectrum for plot
         if self.wavetype == "Regular":
-            self.outf, self.outspec = self.wave.comp_spec()
+            self.stream = iter_periodic(self.wave.ts_volts, self.buffsize)
+        elif self.ts_path is not None:
+            # Play back precomputed random waves
+            self.wave.gen_spec()
+            self.outf, self.outspec = self.wave.f, self.wave.spec
+            self.ts_plot = np.array(self.ts_files["elev"][:nplot])
+            self.stream = iter_blocks(
+                self.ts_files["volts"], self.buffsize, self.nramp
+            )
         else:
+            # Random waves are synthesized indefinitely
+            self.wave.gen_spec()
             self.outf, self.outspec = self.wave.f, self.wave.spec
+            self.stream = stream_ts(self.wave, self.buffsize)
+            print("Random seed entropy:", self.wave.seed_seq.entropy)
 
-        # Ramp time series
-        rampup_ts = ramp_ts(self.dataw, "up")
-
-        # Set making variable true
-        self.making = True
+        # Get parameters from the wave object
+        self.period = self.wave.period
+        self.height = self.wave.height
 
-        self.AOtaskHandle = daqmx.TaskHandle()
-        daqmx.CreateTask("", self.AOtaskHandle)
-        daqmx.CreateAOVoltageChan(
-            self.AOtaskHandle,
-            self.ao_physical_channel,
-            "",
-            -10.0,
-            10.0,
-            daqmx.Val_Volts,
-            None,
+        # Blocks are synthesized in a producer thread into a ring buffer,
+        # and output starts as soon as the first blocks in flight are ready
+        self.ring = BlockRing(max(2 * nblocks, 8), self.buffsize, nblocks)
+        self.vmax = max_halfstroke * self.wave.stroke_cal
+        self.held = []
+        self.producer = threading.Thread(
+            target=self.produce,
+            args=(ramp_up_blocks(self.stream, self.nramp),),
+            daemon=True,
         )
-        daqmx.CfgSampClkTiming(
-            self.AOtaskHandle,
-            "",
-            self.sr,
-            daqmx.Val_Rising,
-            daqmx.Val_ContSamps,
-            self.buffsize,
-        )
-        daqmx.SetWriteRegenMode(self.AOtaskHandle, daqmx.Val_DoNotAllowRegen)
-        print("Writing the rampup time series")
-        # Output the rampup time series
-        daqmx.WriteAnalogF64(
-            self.AOtaskHandle,
-            self.buffsize,
-            False,
-            10.0,
-            daqmx.Val_GroupByChannel,
-            rampup_ts,
-        )
-        daqmx.StartTask(self.AOtaskHandle)
-        self.t_start = time.time()
+        self.producer.start()
+        if self.wavetype != "Regular" and self.ts_path is None:
+            # Plot the first two minutes of elevation for the same phases
+            threading.Thread(
+                target=self.gen_plot, args=(nplot,), daemon=True
+            ).start()
+        else:
+            # Set making variable true
+            self.making = True
+
+        # The hot loop writes blocks straight from the ring's preallocated
+        # slots and logs to memory instead of printing
+        self.max_iteration_time = 0.0
+        return nblocks
+
+    def write_output(self, nblocks):
+        """Write the ring's blocks to the output until disabled or out of
+        data, then ramp down."""
+        budget = self.buffsize / self.sr
+
+        # Write the first blocks in flight, including the rampup
+        self.ring.ready.wait()
         self.n_iterations = 0
-        self.sleep()
+        for _ in range(nblocks):
+            block = self.ring.get()
+            if block is None:
+                break
+            self.output.write(block)
+            self.ring.release()
+        self.output.start()
+        self.log.add("start", self.output.n_written)
 
-        # Main running loop that writes data to DAQmx buffer
-        while self.enable:
-            t0 = time.time()
-            print(
-                "Writing main wave time series data iteration",
-                self.n_iterations,
-            )
-            write_space_avail = daqmx.GetWriteSpaceAvail(self.AOtaskHandle)
-            print("Write space available:", write_space_avail)
-            if self.wavetype != "Regular":
-                if self.n_iterations >= 120:
-                    self.dataw = tsparts[self.n_iterations % 120, :]
-                else:
-                    self.dataw = tsparts[self.n_iterations, :]
-            daqmx.WriteAnalogF64(
-                self.AOtaskHandle,
-                self.buffsize,
-                False,
-                10.0,
-                daqmx.Val_GroupByChannel,
-                self.dataw,
-            )
-            self.n_iterations += 1
-            self.sleep()
+        # Keep the garbage collector from pausing the loop
+        gc_enabled = gc.isenabled()
+        gc.collect()
+        gc.freeze()
+        gc.disable()
+        underruns = self.ring.underruns
+        try:
+            # Main running loop that writes data to DAQmx buffer
+            while self.enable:
+                self.scheduler.wait()
+                if not self.enable:
+                    break
+                t0 = time.perf_counter()
+                self.dataw = self.ring.get()
+                if self.dataw is None:
+                    self.log.add("end")
+                    break
+                self.output.write(self.dataw)
+                self.ring.release()
+                self.n_iterations += 1
+                dt = time.perf_counter() - t0
+                if self.ring.underruns != underruns:
+                    underruns = self.ring.underruns
+                    self.log.add("underrun", underruns)
+                if dt > self.max_iteration_time:
+                    self.max_iteration_time = dt
+                if dt > budget:
+                    self.log.add("overrun", dt)
+        finally:
+            if gc_enabled:
+                gc.enable()
+            gc.unfreeze()
+
+        # Stop the producer and continue from the blocks it made
+        self.ring.close()
+        self.producer.join()
+        stream = itertools.chain(self.ring.drain(), self.held, self.stream)
 
-        print("Output disabled; ramping down")
         # After disabled, initiate rampdown time series
-        if self.wavetype != "Regular":
-            if self.n_iterations >= 120:
-                self.rampdown_ts = ramp_ts(
-                    tsparts[self.n_iterations % 120, :], "down"
-                )
-            else:
-                self.rampdown_ts = ramp_ts(
-                    tsparts[self.n_iterations, :], "down"
-                )
-        else:
-            self.rampdown_ts = ramp_ts(self.dataw, "down")
-        print(f"Writing rampdown time series (len: {len(self.rampdown_ts)})")
-        daqmx.WriteAnalogF64(
-            self.AOtaskHandle,
-            self.buffsize,
-            False,
-            10.0,
-            daqmx.Val_GroupByChannel,
-            self.rampdown_ts,
-        )
-        self.n_iterations += 1.5
-        self.sleep()
+        block, self.stream = take(stream, self.nramp)
+        if len(block) < self.nramp:
+            # Played back series was already ramped down at its end
+            block = np.concatenate([block, np.zeros(self.nramp - len(block))])
+        # Never ramp down from beyond the stroke limit
+        block = np.clip(block, -self.vmax, self.vmax)
+        self.rampdown_ts = ramp_ts(block, "down")
+        self.log.add("rampdown", len(self.rampdown_ts))
+        for start in range(0, self.nramp, self.buffsize):
+            self.scheduler.wait()
+            self.output.write(self.rampdown_ts[start : start + self.buffsize])
         # Write zeros to the buffer
-        print("Writing a buffer of zeros")
-        daqmx.WriteAnalogF64(
-            self.AOtaskHandle,
-            self.buffsize,
-            False,
-            10.0,
-            daqmx.Val_GroupByChannel,
-            np.zeros(self.buffsize),
+        zeros = np.zeros(self.buffsize)
+        self.output.write(zeros)
+        # Stop once the rampdown is out and only zeros remain
+        self.scheduler.wait(len(zeros))
+        print(
+            f"Done ramping down after {self.n_iterations} writes; "
+            f"min samples queued: {self.scheduler.min_queued}, "
+            f"max iteration time: {self.max_iteration_time * 1e3:.2f} ms, "
+            f"overruns: {self.log.total('overrun')}, "
+            f"synthesis underruns: {self.ring.underruns}"
         )
-        self.n_iterations += 1.5
-        self.sleep()
-        daqmx.StopTask(self.AOtaskHandle)
-        daqmx.WaitUntilTaskDone(self.AOtaskHandle, timeout=10.0)
-        print("Done ramping down")
-        daqmx.ClearTask(self.AOtaskHandle)
+
+    def cleanup(self):
+        """Stop the producer and the output task, close a library file and
+        mark the output ramped down, also after an error or if setup did
+        not finish. An error here is kept in ``error`` if output had not
+        already failed."""
+        if self.ring is not None:
+            self.ring.close()
+        if self.producer is not None:
+            self.producer.join()
+        if self.output is not None:
+            for step in (self.output.stop, self.output.clear):
+                try:
+                    step()
+                except Exception as e:
+                    if self.error is None:
+                        self.error = e
+        if self.ts_path is not None and self.case is not None:
+            close_library_case(self.ts_files)
+        self.log.add("stop")
         self.rampeddown = True
+        self.cleared = True
+
+    def produce(self, stream):
+        """Synthesize blocks from ``stream`` into the ring until it ends or
+        the ring is closed. Output ends with a ``StrokeLimitError`` at the
+        first block that would exceed ``max_halfstroke``."""
+        vmax = self.vmax
+        try:
+            while self.ring.reserve():
+                block = next(stream, None)
+                if block is None:
+                    break
+                if block.max() > vmax or block.min() < -vmax:
+                    # Hard stroke limit: end the data here and leave the
+                    # block for the writer to ramp down from, clipped
+                    self.held = [block]
+                    self.ring.error = StrokeLimitError(
+                        "Stroke limit of {} m reached; stopping".format(
+                            max_halfstroke
+                        )
+                    )
+                    break
+                self.ring.put(block)
+            else:
+                return
+        except Exception as e:
+            self.ring.error = e
+        self.ring.finish()
 
-    def sleep(self):
-        """Sleep between iterations.
-
-        Our goal is to always stay ahead of the FIFO buffer being empty.
-        """
-        # Based on how long we've been running and how many iterations we've
-        # done, compute a time to sleep
-        t_total = time.time() - self.t_start
-        print("t_total:", t_total)
-        iteration_period = self.period if self.wavetype == "Regular" else 1.0
-        t_expected = iteration_period * self.n_iterations
-        print("t_expected:", t_expected)
-        sleeptime = t_expected - t_total - 0.2
-        if sleeptime > 0:
-            print("Sleeping", sleeptime, "seconds")
-            time.sleep(sleeptime)
+    def gen_plot(self, nplot):
+        """Synthesize the first ``nplot`` samples of random wave elevation
+        for plotting, while output runs."""
+        elev = stream_ts(self.wave, self.buffsize, output="elev")
+        self.ts_plot, elev = take(elev, nplot)
+        self.making = True
 
     def stop(self):
         self.stopgen = WaveStop(self)
@@ -4,8 +4,9 @@ safe wave height.
 
 from __future__ import division, print_function, absolute_import
 import numpy as np
+import hashlib
+import json
 import os
-import sys
 
 _thisdir = os.path.dirname(os.path.abspath(__file__))
 settings_dir = os.path.join(_thisdir, "settings")
@@ -17,73 +18,270 @@ min_period = 0.5
 max_period = 5.0
 max_H_L = 0.1
 max_H_d = 0.65
+g = 9.81
 
+# Operating depths covered by the max wave height surface
+min_depth = 1.5
+max_depth = 2.6
 
-def dispsolver(rad_frequency, depth, decimals=2):
-    """Solves for surface wavenumber to a specified number of decimals."""
-    g = 9.81
-    k = np.arange(0, 30, 10**-(decimals))
-    r = np.abs(rad_frequency**2 - g*k*np.tanh(k*depth))
-    return k[np.where(r == np.min(r))[0][0]]
+# Increment when changes to the solver or limit logic alter the tables
+solver_version = 2
 
+# Dispersion solver convergence criteria
+newton_tol = 4*np.finfo(float).eps
+newton_maxiter = 20
 
-def revdispsolver(wavenumber, depth, decimals=2):
-    """Returns radian frequency given wavenumber and depth"""
-    g = 9.81
-    k = wavenumber
-    sigma = np.arange(0, 10, 10**-(decimals))
-    r = np.abs(sigma**2 - g*k*np.tanh(k*depth))
-    return sigma[np.where(r == np.min(r))[0][0]]
+
+def solve_kh(omega2h_g):
+    """Solves kh*tanh(kh) = omega**2*h/g exactly for dimensionless kh.
+
+    Newton iterations are started from Eckart's approximation and converge to
+    machine precision in a handful of steps. Works on scalars or arrays.
+    """
+    y = np.asarray(omega2h_g, dtype=float)
+    kh = np.zeros(y.shape)
+    pos = y > 0
+    yp = y[pos]
+    x = yp/np.sqrt(np.tanh(yp))
+    for _ in range(newton_maxiter):
+        t = np.tanh(x)
+        dx = (x*t - yp)/(t + x*(1 - t**2))
+        x = x - dx
+        if np.all(np.abs(dx) <= newton_tol*x):
+            break
+    kh[pos] = x
+    if kh.ndim == 0:
+        return kh[()]
+    return kh
+
+
+class DispersionTable(object):
+    """Lookup table mapping the dimensionless omega**2*h/g to kh and back.
+
+    kh is tabulated against s = sqrt(omega**2*h/g) on a uniform grid, which
+    makes it smooth in both the shallow (kh ~ s) and deep (kh ~ s**2) limits,
+    and is evaluated by cubic Hermite interpolation using the exact slope of
+    the dispersion relation at each node. Past ``kh_max`` tanh(kh) is 1 to
+    machine precision and the deep water relation is used directly. The
+    largest relative error against ``solve_kh``, sampled between the nodes at
+    construction, is stored in ``max_rel_error``.
+    """
+
+    def __init__(self, npoints=1024, kh_max=20.0, ncheck=8):
+        self.kh_max = kh_max
+        self.y_max = kh_max*np.tanh(kh_max)
+        self.s = np.linspace(0, np.sqrt(self.y_max), npoints)
+        self.ds = self.s[1] - self.s[0]
+        self.kh_nodes = solve_kh(self.s**2)
+        # Slope d(kh)/ds, which tends to 1 at s = 0
+        x = self.kh_nodes
+        t = np.tanh(x)
+        self.slopes = np.ones(npoints)
+        self.slopes[1:] = 2*self.s[1:]/(t[1:] + x[1:]*(1 - t[1:]**2))
+        # Check against exact solutions between the nodes
+        s_check = np.linspace(0, self.s[-1], ncheck*(npoints - 1) + 1)[1:]
+        y_check = np.concatenate([s_check**2, [self.y_max*1.5]])
+        exact = solve_kh(y_check)
+        self.max_rel_error = np.max(np.abs(self.kh(y_check) - exact)/exact)
+
+    def kh(self, omega2h_g):
+        """Returns kh for dimensionless omega**2*h/g."""
+        y = np.asarray(omega2h_g, dtype=float)
+        u = np.sqrt(np.minimum(y, self.y_max))/self.ds
+        i = np.minimum(u.astype(int), len(self.s) - 2)
+        t = u - i
+        t2 = t*t
+        t3 = t2*t
+        kh = (2*t3 - 3*t2 + 1)*self.kh_nodes[i] \
+            + (t3 - 2*t2 + t)*self.ds*self.slopes[i] \
+            + (-2*t3 + 3*t2)*self.kh_nodes[i + 1] \
+            + (t3 - t2)*self.ds*self.slopes[i + 1]
+        kh = np.where(y > self.y_max, y, kh)
+        if kh.ndim == 0:
+            return kh[()]
+        return kh
+
+    def omega2h_g(self, kh):
+        """Returns dimensionless omega**2*h/g for kh, which is explicit."""
+        kh = np.asarray(kh, dtype=float)
+        y = kh*np.tanh(kh)
+        if y.ndim == 0:
+            return y[()]
+        return y
+
+
+# Shared by everything that needs to solve the dispersion relation
+disp_table = DispersionTable()
+
+
+def dispsolver(rad_frequency, depth, decimals=None, exact=False):
+    """Returns surface wavenumber for radian frequency and depth.
+
+    Scalars or arrays are accepted and broadcast against each other. By
+    default kh is looked up in the shared ``disp_table``; set ``exact=True``
+    to solve the dispersion relation with ``solve_kh`` instead. The
+    ``decimals`` argument is kept for backwards compatibility and is ignored.
+    """
+    omega = np.asarray(rad_frequency, dtype=float)
+    h = np.asarray(depth, dtype=float)
+    y = omega**2*h/g
+    if exact:
+        kh = solve_kh(y)
+    else:
+        kh = disp_table.kh(y)
+    return kh/h
+
+
+def revdispsolver(wavenumber, depth, decimals=None):
+    """Returns radian frequency given wavenumber and depth.
+
+    The dispersion relation is explicit in this direction, so
+    omega = sqrt(g*k*tanh(k*h)) is evaluated directly. Scalars or arrays are
+    accepted and broadcast against each other. The ``decimals`` argument is
+    kept for backwards compatibility and is ignored.
+    """
+    k = np.asarray(wavenumber, dtype=float)
+    h = np.asarray(depth, dtype=float)
+    return np.sqrt(g*k*np.tanh(k*h))
+
+
+def period_to_wavelength(period, depth):
+    """Returns wavelength for wave period and depth."""
+    return 2*np.pi/dispsolver(2*np.pi/np.asarray(period, dtype=float), depth)
+
+
+def wavelength_to_period(wavelength, depth):
+    """Returns wave period for wavelength and depth."""
+    k = 2*np.pi/np.asarray(wavelength, dtype=float)
+    return 2*np.pi/revdispsolver(k, depth)
+
+
+def flap_transfer(kh):
+    """Returns the Biesel ratio of wave height to flap stroke at the mean
+    water level, H/S = 4*sinh(kh)/kh*(kh*sinh(kh) - cosh(kh) + 1)
+    /(sinh(2kh) + 2kh), for scalar or array kh.
+
+    The expression is rewritten in terms of exp(-kh) so it stays finite for
+    large kh, where it tends to 2*(kh - 1)/kh, and accurate for small kh,
+    where it tends to kh/2. Zero is returned for kh = 0.
+    """
+    x = np.asarray(kh, dtype=float)
+    one_m_e = -np.expm1(-x)
+    one_m_e2 = -np.expm1(-2*x)
+    one_m_e4 = -np.expm1(-4*x)
+    e2 = np.exp(-2*x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hs = one_m_e2*(x*one_m_e2 - one_m_e**2)/(x*(one_m_e4/2 + 2*x*e2))
+    hs = np.where(x == 0, 0.0, hs)
+    if hs.ndim == 0:
+        return hs[()]
+    return hs
+
+
+def stroke_gain(rad_frequency, depth, flap_height):
+    """Returns flap stroke per unit surface elevation.
+
+    This is the linear transfer function from elevation to stroke at the
+    top of a flap of height ``flap_height`` hinged ``depth`` below the
+    surface. All arguments broadcast against each other; the gain is
+    infinite at zero frequency.
+    """
+    h = np.asarray(depth, dtype=float)
+    kh = dispsolver(rad_frequency, h)*h
+    with np.errstate(divide="ignore"):
+        return np.asarray(flap_height, dtype=float)/h/flap_transfer(kh)
 
 
 def height_to_stroke_amp(wave_height, period, flap_height, depth):
-    sigma = 2*np.pi/period
-    h = depth
-    k = dispsolver(sigma, h)
-    H = wave_height
-    S = H/(4*(np.sinh(k*h)/(k*h))*(k*h*np.sinh(k*h) - \
-    np.cosh(k*h) + 1)/(np.sinh(2*k*h) + 2*k*h))
-    return flap_height/depth*S/2.0
+    """Returns flap stroke amplitude for wave height and period."""
+    omega = 2*np.pi/np.asarray(period, dtype=float)
+    return wave_height/2.0*stroke_gain(omega, depth, flap_height)
 
 
 def stroke_amp_to_height(stroke_amp, period, flap_height, depth):
-    sigma = 2*np.pi/period
-    h = depth
-    k = dispsolver(sigma, h)
-    S = 2*stroke_amp*depth/flap_height
-    H = S*(4*(np.sinh(k*h)/(k*h))*(k*h*np.sinh(k*h) - \
-    np.cosh(k*h) + 1)/(np.sinh(2*k*h) + 2*k*h))
-    return H
+    """Returns wave height for flap stroke amplitude and period."""
+    omega = 2*np.pi/np.asarray(period, dtype=float)
+    return 2*stroke_amp/stroke_gain(omega, depth, flap_height)
+
+
+def tank_constants(**overrides):
+    """Returns a dict of the tank constants used to compute the limits.
 
+    Values are read from the module at call time; keyword arguments override
+    individual constants, e.g. to evaluate a candidate stroke policy.
+    """
+    constants = {"max_halfstroke": max_halfstroke,
+                 "flap_height": flap_height,
+                 "depth": depth,
+                 "max_H_L": max_H_L,
+                 "max_H_d": max_H_d}
+    for name in overrides:
+        if name not in constants:
+            raise ValueError("Unknown tank constant: " + name)
+    constants.update(overrides)
+    return constants
 
-def calc_safe_height(H, T):
-    sta_spec = height_to_stroke_amp(H, T, flap_height, depth)
+
+def calc_safe_height(H, T, **overrides):
+    """Returns the largest safe wave height, up to H, for periods T.
+
+    T may be an array, in which case the dispersion relation and flap
+    transfer function are evaluated once for the whole vector. Tank constants
+    may be overridden by keyword, see ``tank_constants``.
+    """
+    c = tank_constants(**overrides)
+    h = c["depth"]
+    T = np.asarray(T, dtype=float)
+    k = dispsolver(2*np.pi/T, h)
+    # Stroke amplitude per unit wave height
+    sta_per_H = stroke_gain(2*np.pi/T, h, c["flap_height"])/2.0
+    sta_spec = H*sta_per_H
     # Wave height using max piston stroke
-    wh1 = stroke_amp_to_height(max_halfstroke, T, flap_height, depth)
+    wh1 = c["max_halfstroke"]/sta_per_H
     # Wave height using max H/L
-    wh2 = max_H_L * 2*np.pi/dispsolver(2*np.pi/T, depth)
+    wh2 = c["max_H_L"]*2*np.pi/k
     # Wave height using max H/d
-    wh3 = max_H_d * depth
+    wh3 = c["max_H_d"]*h*np.ones(T.shape)
     # Stroke amplitude calculated using max H/L
-    sta2 = height_to_stroke_amp(wh2, T, flap_height, depth)
+    sta2 = wh2*sta_per_H
     # Stroke amplitude calculated using max H/d
-    sta3 = height_to_stroke_amp(wh3, T, flap_height, depth)
-    if sta_spec > np.min([max_halfstroke, sta2, sta3]):
-        return np.min([wh1, wh2, wh3])
-    else:
-        return H
-
-
-def findlimits(plot=False, save=True):
-    periods = np.arange(0.5, 5.01, 0.001)
-    mh = np.zeros(len(periods))
-    for n in range(len(periods)):
-        progress = np.round(n/len(periods)*100, decimals=2)
-        sys.stdout.write("\rComputing wavemaker limits... " \
-                         + str(progress)+"%")
-        sys.stdout.flush()
-        mh[n] = calc_safe_height(50, periods[n])
-    print("")
+    sta3 = wh3*sta_per_H
+    limit = np.minimum(np.minimum(c["max_halfstroke"], sta2), sta3)
+    mh = np.where(sta_spec > limit, np.minimum(np.minimum(wh1, wh2), wh3), H)
+    if mh.ndim == 0:
+        return mh[()]
+    return mh
+
+
+def limits_fingerprint(resolution=0.001, min_period=min_period,
+                       max_period=max_period):
+    """Returns a dict describing everything the limits tables depend on.
+
+    Module constants are read at call time, so changing any of them (or
+    ``solver_version``) produces a different fingerprint.
+    """
+    fp = tank_constants()
+    fp.update({"solver_version": solver_version,
+               "g": g,
+               "min_period": min_period,
+               "max_period": max_period,
+               "resolution": resolution})
+    blob = json.dumps(fp, sort_keys=True).encode()
+    fp["hash"] = hashlib.sha1(blob).hexdigest()
+    return fp
+
+
+def findlimits(plot=False, save=True, resolution=0.001,
+               min_period=min_period, max_period=max_period):
+    """Computes the safe wave height curve over a range of periods.
+
+    The whole period vector, spaced by ``resolution`` seconds, is computed in
+    one pass. If ``save`` is true the tables are written to the settings
+    directory along with their fingerprint. Returns periods, maxH.
+    """
+    nperiods = int(round((max_period - min_period)/resolution)) + 1
+    periods = np.linspace(min_period, max_period, nperiods)
+    mh = calc_safe_height(50, periods)
     if plot:
         import matplotlib.pyplot as plt
         plt.plot(periods, mh)
@@ -92,8 +290,264 @@ def findlimits(plot=False, save=True):
             os.mkdir(settings_dir)
         np.save(os.path.join(settings_dir, "periods"), periods)
         np.save(os.path.join(settings_dir, "maxH"), mh)
+        # Written last so an interrupted save is never trusted
+        fp = limits_fingerprint(resolution, min_period, max_period)
+        with open(os.path.join(settings_dir, "limits.json"), "w") as f:
+            json.dump(fp, f, indent=4, sort_keys=True)
     return periods, mh
 
 
+def load_limits(resolution=0.001, min_period=min_period,
+                max_period=max_period):
+    """Loads the cached limits tables, recomputing them if they are stale.
+
+    The tables are reused only if the fingerprint saved with them matches
+    ``limits_fingerprint`` for the current constants, in which case they are
+    memory-mapped read-only. Returns periods, maxH.
+
+    These tables are for the default depth only. The GUI uses
+    ``load_limits_surface``, which covers all water depths; this loader and
+    the tables in the settings directory are kept for scripts using the
+    single-depth curve.
+    """
+    fp = limits_fingerprint(resolution, min_period, max_period)
+    periods_fpath = os.path.join(settings_dir, "periods.npy")
+    maxh_fpath = os.path.join(settings_dir, "maxH.npy")
+    try:
+        with open(os.path.join(settings_dir, "limits.json")) as f:
+            cached = json.load(f)
+        if cached.get("hash") == fp["hash"]:
+            return (np.load(periods_fpath, mmap_mode="r"),
+                    np.load(maxh_fpath, mmap_mode="r"))
+        print("Wavemaker limit settings are out of date")
+    except (IOError, ValueError):
+        print("No wavemaker limit settings found")
+    print("Computing wavemaker limits")
+    return findlimits(save=True, resolution=resolution,
+                      min_period=min_period, max_period=max_period)
+
+
+class LimitsSurface(object):
+    """Max safe wave height over a regular grid of periods and depths.
+
+    Lookups use bilinear interpolation on the uniform grid, so any operating
+    depth within the grid can be used without recomputing anything.
+    """
+
+    def __init__(self, periods, depths, maxH):
+        self.periods = periods
+        self.depths = depths
+        self.maxH = maxH
+        self.dT = periods[1] - periods[0]
+        self.dh = depths[1] - depths[0]
+
+    def _locate(self, x, x0, dx, n):
+        u = np.clip((np.asarray(x, dtype=float) - x0)/dx, 0, n - 1)
+        i = np.minimum(u.astype(int), n - 2)
+        return i, u - i
+
+    def __call__(self, period, depth):
+        """Returns interpolated max wave height for period and depth."""
+        i, s = self._locate(period, self.periods[0], self.dT,
+                            len(self.periods))
+        j, t = self._locate(depth, self.depths[0], self.dh, len(self.depths))
+        m = self.maxH
+        mh = (1 - t)*((1 - s)*m[j, i] + s*m[j, i + 1]) \
+            + t*((1 - s)*m[j + 1, i] + s*m[j + 1, i + 1])
+        if mh.ndim == 0:
+            return mh[()]
+        return mh
+
+    def curve(self, depth):
+        """Returns periods, maxH interpolated to a single depth."""
+        j, t = self._locate(depth, self.depths[0], self.dh, len(self.depths))
+        maxH = (1 - t)*self.maxH[j] + t*self.maxH[j + 1]
+        return np.asarray(self.periods), maxH
+
+
+class LimitsIndex(object):
+    """Constant time max safe wave height lookups along one limits curve.
+
+    ``periods`` must be uniformly spaced. Heights are linearly interpolated
+    between grid points, periods outside the grid are clamped to its ends,
+    and results are rounded down (not to nearest) to ``decimals``, so a cap
+    shown in the GUI is never rounded up past the limit.
+    """
+
+    def __init__(self, periods, maxH, depth=depth, decimals=3):
+        self.periods = np.asarray(periods, dtype=float)
+        self.maxH = np.asarray(maxH, dtype=float)
+        self.depth = depth
+        self.decimals = decimals
+        self.T0 = self.periods[0]
+        self.dT = self.periods[1] - self.periods[0]
+        self.n = len(self.periods)
+
+    def max_height(self, period):
+        """Returns the max safe wave height for wave period."""
+        u = np.clip((np.asarray(period, dtype=float) - self.T0)/self.dT,
+                    0, self.n - 1)
+        i = np.minimum(u.astype(int), self.n - 2)
+        t = u - i
+        mh = (1 - t)*self.maxH[i] + t*self.maxH[i + 1]
+        scale = 10**self.decimals
+        mh = np.floor(mh*scale)/scale
+        if mh.ndim == 0:
+            return float(mh)
+        return mh
+
+    def max_height_for_wavelength(self, wavelength):
+        """Returns the max safe wave height for wavelength."""
+        return self.max_height(wavelength_to_period(wavelength, self.depth))
+
+
+def surface_fingerprint(resolution=0.005, depth_resolution=0.01,
+                        min_period=min_period, max_period=max_period,
+                        min_depth=min_depth, max_depth=max_depth):
+    """Returns a dict describing everything the limits surface depends on."""
+    fp = tank_constants()
+    del fp["depth"]
+    fp.update({"solver_version": solver_version,
+               "g": g,
+               "min_period": min_period,
+               "max_period": max_period,
+               "resolution": resolution,
+               "min_depth": min_depth,
+               "max_depth": max_depth,
+               "depth_resolution": depth_resolution})
+    blob = json.dumps(fp, sort_keys=True).encode()
+    fp["hash"] = hashlib.sha1(blob).hexdigest()
+    return fp
+
+
+def _grid(start, stop, resolution):
+    return np.linspace(start, stop, int(round((stop - start)/resolution)) + 1)
+
+
+def find_limits_surface(save=True, resolution=0.005, depth_resolution=0.01,
+                        min_period=min_period, max_period=max_period,
+                        min_depth=min_depth, max_depth=max_depth):
+    """Computes the max safe wave height over periods and depths.
+
+    The surface is stored as single precision in ``maxH_surface.npy``, with
+    its grid and fingerprint in ``limits_surface.json``. Returns a
+    LimitsSurface.
+    """
+    periods = _grid(min_period, max_period, resolution)
+    depths = _grid(min_depth, max_depth, depth_resolution)
+    mh = calc_safe_height(50, periods[np.newaxis, :],
+                          depth=depths[:, np.newaxis])
+    mh = mh.astype(np.float32)
+    if save:
+        if not os.path.isdir(settings_dir):
+            os.mkdir(settings_dir)
+        np.save(os.path.join(settings_dir, "maxH_surface"), mh)
+        fp = surface_fingerprint(resolution, depth_resolution, min_period,
+                                 max_period, min_depth, max_depth)
+        with open(os.path.join(settings_dir, "limits_surface.json"),
+                  "w") as f:
+            json.dump(fp, f, indent=4, sort_keys=True)
+    return LimitsSurface(periods, depths, mh)
+
+
+def load_limits_surface(resolution=0.005, depth_resolution=0.01,
+                        min_period=min_period, max_period=max_period,
+                        min_depth=min_depth, max_depth=max_depth):
+    """Loads the cached limits surface, recomputing it if it is stale.
+
+    Returns a LimitsSurface backed by a read-only memory map when the saved
+    fingerprint matches.
+    """
+    fp = surface_fingerprint(resolution, depth_resolution, min_period,
+                             max_period, min_depth, max_depth)
+    try:
+        with open(os.path.join(settings_dir, "limits_surface.json")) as f:
+            cached = json.load(f)
+        if cached.get("hash") == fp["hash"]:
+            mh = np.load(os.path.join(settings_dir, "maxH_surface.npy"),
+                         mmap_mode="r")
+            return LimitsSurface(_grid(min_period, max_period, resolution),
+                                 _grid(min_depth, max_depth,
+                                       depth_resolution), mh)
+        print("Wavemaker limits surface is out of date")
+    except (IOError, ValueError):
+        print("No wavemaker limits surface found")
+    print("Computing wavemaker limits surface")
+    return find_limits_surface(True, resolution, depth_resolution,
+                               min_period, max_period, min_depth, max_depth)
+
+
+def _sweep_chunk(task):
+    """Computes one chunk of periods for one scenario in a worker process."""
+    scenario, i0, i1, nperiods, min_period, max_period = task
+    step = (max_period - min_period)/(nperiods - 1)
+    periods = min_period + np.arange(i0, i1)*step
+    return scenario, periods, calc_safe_height(50, periods, **scenario)
+
+
+def sweep(scenarios=None, resolution=0.001, min_period=min_period,
+          max_period=max_period, chunk_size=100000, max_workers=None):
+    """Computes limit curves for many scenarios across a process pool.
+
+    Each scenario is a dict of tank constant overrides (see
+    ``tank_constants``). Periods are split into chunks of at most
+    ``chunk_size`` and every (scenario, chunk) pair is computed in parallel on
+    up to ``max_workers`` processes (all cores by default). Returns a long
+    format DataFrame with one row per scenario and period.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import pandas as pd
+    if scenarios is None:
+        scenarios = [{}]
+    nperiods = int(round((max_period - min_period)/resolution)) + 1
+    tasks = [(scenario, i0, min(i0 + chunk_size, nperiods), nperiods,
+              min_period, max_period)
+             for scenario in scenarios
+             for i0 in range(0, nperiods, chunk_size)]
+    frames = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for scenario, periods, mh in executor.map(_sweep_chunk, tasks):
+            df = pd.DataFrame({"period": periods, "max_height": mh})
+            for name, value in tank_constants(**scenario).items():
+                df.insert(len(df.columns) - 2, name, value)
+            frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def cli(args=None):
+    """Command line interface for computing limit curves.
+
+    Several values may be given for each tank constant, in which case a
+    scenario is run for every combination.
+    """
+    import argparse
+    import itertools
+    parser = argparse.ArgumentParser(
+        description="Compute wavemaker safe wave height limits.")
+    for name, value in tank_constants().items():
+        parser.add_argument("--" + name.replace("_", "-"), type=float,
+                            nargs="+", default=[value], dest=name,
+                            help="default: {}".format(value))
+    parser.add_argument("--resolution", type=float, default=0.001,
+                        help="period resolution in seconds")
+    parser.add_argument("--min-period", type=float, default=min_period)
+    parser.add_argument("--max-period", type=float, default=max_period)
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of processes (default: all cores)")
+    parser.add_argument("--output", "-o", default="limits.csv",
+                        help="CSV file to write")
+    args = parser.parse_args(args)
+    names = list(tank_constants())
+    scenarios = [dict(zip(names, values)) for values in
+                 itertools.product(*[getattr(args, n) for n in names])]
+    print("Computing limits for", len(scenarios), "scenario(s)")
+    df = sweep(scenarios, resolution=args.resolution,
+               min_period=args.min_period, max_period=args.max_period,
+               chunk_size=args.chunk_size, max_workers=args.workers)
+    df.to_csv(args.output, index=False)
+    print("Wrote", len(df), "rows to", args.output)
+
+
 if __name__ == "__main__":
-    findlimits(plot=False, save=False)
+    cli()
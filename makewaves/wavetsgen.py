@@ -28,18 +28,25 @@ Removed parameters:
 
 """
 from __future__ import division, print_function
+import copy
+import functools
+import json
+import os
 import numpy as np
-from numpy import pi, sinh, cosh
+from numpy import pi
 
 try:
-    from wavemakerlimits import dispsolver
+    from wavemakerlimits import max_halfstroke, stroke_gain
 except ImportError:
-    from .wavemakerlimits import dispsolver
+    from .wavemakerlimits import max_halfstroke, stroke_gain
 
 # Constants
 stroke_cal = 15.7130  # V/m stroke, used to be 7.8564, might need to be 18?
+max_volts = 10.0  # Analog output range
 paddle_height = 3.3147
 water_depth = 2.44
+check_duration = 3600.0  # s of streamed output checked against stroke limit
+stream_frame_size = 8192  # Samples per overlap-added frame of random waves
 g = 9.81
 
 
@@ -59,72 +66,279 @@ def psd(t, data, window=None):
     return f, psd
 
 
-def spec2ts(spec, sr):
-    """Create time series with random (normal) phases from power spectrum."""
+def spec2ts(spec, sr, rng=None):
+    """Create time series with random (normal) phases from power spectrum.
+
+    Phases are drawn from ``rng``, a ``np.random.Generator``, or from a
+    freshly seeded one if not given.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    phase = rng.normal(0, pi, len(spec))
+    return phases2ts(spec, sr, phase)
+
+
+def phases2ts(spec, sr, phase):
+    """Create time series from power spectrum and phases.
+
+    ``phase`` may be 2-D, with one set of phases per row, in which case all
+    realizations are computed with a single batched inverse FFT and returned
+    as rows.
+    """
     sr = int(sr)
-    phase = np.random.normal(0, pi, len(spec))
-    ts_elev = np.fft.irfft(np.sqrt(spec * len(spec) * sr) * np.exp(1j * phase))
+    amp = np.sqrt(spec * len(spec) * sr)
+    ts_elev = np.fft.irfft(amp * np.exp(1j * phase), axis=-1)
     # Taper down last second of ts so it can repeat
-    ramp = np.hanning(sr * 2)[0:sr]
-    ts_elev[:sr] = ts_elev[:sr] * ramp
-    ramp = np.hanning(sr * 2)[sr:]
-    ts_elev[-sr:] = ts_elev[-sr:] * ramp
+    ramp = np.hanning(sr * 2)
+    ts_elev[..., :sr] *= ramp[:sr]
+    ts_elev[..., -sr:] *= ramp[sr:]
     return ts_elev
 
 
-def elev2stroke(ts_elev, waveheight, waveperiod):
+def elev2stroke(ts_elev, waveheight, waveperiod, depth=None):
     """Computes piston stroke from elevation time series.
     Still needs to be checked for random waves parameters."""
-    k = dispsolver(2 * pi / waveperiod, water_depth, decimals=2)
-    kh = k * water_depth
-    factor = paddle_height / water_depth
-    stroke = (
-        4
-        * (sinh(kh) / kh)
-        * (kh * sinh(kh) - cosh(kh) + 1)
-        / (sinh(2 * kh) + 2 * kh)
-    )
-    return ts_elev * factor / stroke
-
-
-def spec2stroke(omega, spec, sr):
-    """Converts a spectrum into piston stroke"""
-    phase = np.random.normal(0, pi, len(spec))
-    A = np.sqrt(2 * spec * (omega[1] - omega[0]))
-    t = np.arange(0, len(spec)) / sr
-    ts_stroke = np.zeros(len(t))
-    for n in range(len(omega)):
-        ts_elev = A[n] * np.sin(omega[n] * t + phase[n])
-        ts_stroke += elev2stroke(ts_elev, A[n] * 2, 2 * np.pi / omega[n])
+    if depth is None:
+        depth = water_depth
+    return ts_elev * stroke_gain(2 * pi / waveperiod, depth, paddle_height)
+
+
+def spec2stroke(omega, spec, sr, n_samples=None, depth=None, rng=None):
+    """Converts a spectrum into piston stroke.
+
+    The stroke is the sum of one sinusoid per spectral component, each with a
+    random phase and scaled by the flap transfer function. ``omega`` must be
+    uniformly spaced. When the components are harmonics of a period that is a
+    whole number of samples, as for ``Wave`` frequency grids, the sum is
+    evaluated exactly with an inverse real FFT and repeats with that period;
+    otherwise it falls back to direct summation. Returns ``n_samples``
+    samples, ``len(spec)`` by default. Phases are drawn from ``rng`` as in
+    ``spec2ts``.
+    """
+    if depth is None:
+        depth = water_depth
+    if n_samples is None:
+        n_samples = len(spec)
+    if rng is None:
+        rng = np.random.default_rng()
+    phase = rng.normal(0, pi, len(spec))
+    domega = omega[1] - omega[0]
+    A = np.sqrt(2 * spec * domega)
+    # Stroke amplitude of each component
+    B = A * stroke_gain(omega, depth, paddle_height)
+    # Number of samples in one period of the fundamental, and the harmonic
+    # number of each component
+    L = 2 * pi * sr / domega
+    m = omega / domega
+    # Tolerances are absolute, in samples and harmonic numbers, so grids off
+    # by a fraction of a sample take the direct summation path
+    if abs(L - np.round(L)) < 1e-6 and np.allclose(
+        m, np.round(m), rtol=0, atol=1e-6
+    ):
+        L = int(np.round(L))
+        m = np.round(m).astype(int)
+        # irfft of X gives sum of 2/L*|X|*cos(...), so sin(wt + phase) is
+        # represented by -1j*L/2*exp(1j*phase)
+        X = np.zeros(L // 2 + 1, dtype=complex)
+        X[m] = -0.5j * L * B * np.exp(1j * phase)
+        # DC and Nyquist bins only contribute their real part, once
+        for edge in (0, L // 2):
+            i = np.where(m == edge)[0]
+            if len(i) and (edge == 0 or L % 2 == 0):
+                X[edge] = L * B[i[0]] * np.sin(phase[i[0]])
+        ts_stroke = np.fft.irfft(X, L)
+        return np.resize(ts_stroke, n_samples)
+    t = np.arange(n_samples) / sr
+    ts_stroke = np.zeros(n_samples)
+    # Sum in blocks of components to bound memory use
+    nblock = max(1, 2**22 // n_samples)
+    for i in range(0, len(omega), nblock):
+        s = slice(i, i + nblock)
+        ts_stroke += np.sin(np.outer(t, omega[s]) + phase[s]) @ B[s]
     return ts_stroke
 
 
-def elev2stroke2(ts_elev, sr):
+@functools.lru_cache(maxsize=32)
+def band_stroke_gain(N, sr, depth, flap_height):
+    """Returns the rfft-domain elevation to stroke gain used by elev2stroke2.
+
+    The flap transfer function is evaluated for frequencies corresponding to
+    T = 0.25--8 s and every other bin is zeroed. The gain includes a factor
+    of 1/2 because the original complex FFT implementation zeroed the
+    negative frequency bins before taking the real part, and output
+    amplitudes are kept consistent with it.
+
+    Results are kept in a bounded LRU cache keyed by the arguments, and are
+    read-only so they can be shared between threads. Use
+    ``band_stroke_gain.cache_info()`` for hit/miss statistics.
+    """
+    n = np.arange(N // 1024, N // 32)
+    f = n * sr / N * (1 - 2 / N) + 1 / (sr * N)
+    gain = np.zeros(N // 2 + 1)
+    gain[n] = 0.5 * stroke_gain(2 * pi * f, depth, flap_height)
+    gain.flags.writeable = False
+    return gain
+
+
+def elev2stroke2(ts_elev, sr, depth=None):
     """Converts a random elevation time series to piston stroke time series
-    HS=(4*sinh(x)/x)*((x*sinh(x)-cosh(x)+1)/(sinh(2*x)+2*x));
+    by applying ``band_stroke_gain`` to its real FFT. A 2-D array is
+    converted row by row.
     """
-    # Find kh vector for omegas
-    N = len(ts_elev)
-    HS = np.ones(N) * 1e12
-    # Only compute HS for frequencies corresponding to T = 0.25--8 Hz
-    for n in range(N // 1024, N // 32):
-        f = n * sr / N * (1 - 2 / N) + 1 / (sr * N)
-        omega = 2 * pi * f
-        kh = water_depth * dispsolver(omega, water_depth, decimals=1)
-        HS[n] = (4 * sinh(kh) / kh) * (
-            (kh * sinh(kh) - cosh(kh) + 1) / (sinh(2 * kh) + 2 * kh)
-        )
-    HS[np.where(np.isnan(HS))[0]] = 1e12
-    fft_ts = np.fft.fft(ts_elev)
-    A = np.absolute(fft_ts) / HS * paddle_height / water_depth
-    ts_stroke = np.fft.ifft(A * np.exp(1j * np.angle(fft_ts)))
-    return ts_stroke.real
+    if depth is None:
+        depth = water_depth
+    N = np.shape(ts_elev)[-1]
+    spec = np.fft.rfft(ts_elev, axis=-1)
+    spec *= band_stroke_gain(N, float(sr), float(depth), paddle_height)
+    return np.fft.irfft(spec, N, axis=-1)
 
 
 def stroke2volts(stroke):
     return stroke * stroke_cal
 
 
+class Spectrum(object):
+    """Base class for a family of random wave spectra.
+
+    Subclasses set ``name`` and ``parameters``, a list of
+    (attribute, label, default) tuples, implement ``_spectrum`` and
+    ``characteristic``, and are added to ``spectra`` with
+    ``register_spectrum``. If the spectrum scales with the square of one
+    parameter, leaving its shape unchanged, its name is ``height_param``.
+    """
+
+    name = None
+    parameters = []
+    height_param = None
+
+    def defaults(self):
+        """Returns a dict of default parameter values."""
+        return {attr: default for attr, label, default in self.parameters}
+
+    def evaluate(self, f, **params):
+        """Evaluates the spectrum on frequency grid ``f`` (Hz).
+
+        Each parameter may be a scalar or a 1-D array giving a batch of
+        parameter sets; omitted parameters take their defaults. Returns an
+        array of shape (number of parameter sets, len(f)).
+        """
+        values = self.defaults()
+        for attr in params:
+            if attr not in values:
+                raise ValueError(
+                    "Unknown {} parameter: {}".format(self.name, attr)
+                )
+        values.update(params)
+        values = {
+            attr: np.atleast_1d(np.asarray(v, dtype=float))
+            for attr, v in values.items()
+        }
+        nbatch = np.broadcast_shapes(*[v.shape for v in values.values()])
+        values = {
+            attr: np.broadcast_to(v, nbatch)[:, np.newaxis]
+            for attr, v in values.items()
+        }
+        f = np.asarray(f, dtype=float)[np.newaxis, :]
+        spec = self._spectrum(f, **values)
+        return np.array(np.broadcast_to(spec, nbatch + f.shape[1:]))
+
+    def _spectrum(self, f, **params):
+        raise NotImplementedError
+
+    def characteristic(self, **params):
+        """Returns characteristic wave height and period."""
+        raise NotImplementedError
+
+
+spectra = {}
+
+
+def register_spectrum(cls):
+    """Class decorator that adds a Spectrum subclass to ``spectra``."""
+    spectra[cls.name] = cls()
+    return cls
+
+
+@register_spectrum
+class Bretschneider(Spectrum):
+    name = "Bretschneider"
+    height_param = "sig_height"
+    parameters = [
+        ("sig_height", "Significant Wave Height", 0.1),
+        ("sig_period", "Significant Wave Period", 1.0),
+        ("scale_ratio", "Scale Ratio", 1.0),
+    ]
+
+    def _spectrum(self, f, sig_height, sig_period, scale_ratio):
+        f0 = 1 / sig_period
+        return (
+            (5 / 16)
+            * sig_height**2
+            / f0
+            / (f / f0) ** 5
+            * np.exp(-5 / 4 * (f / f0) ** -4)
+        )
+
+    def characteristic(self, sig_height, sig_period, **params):
+        return sig_height, sig_period
+
+
+@register_spectrum
+class JONSWAP(Spectrum):
+    name = "JONSWAP"
+    height_param = "sig_height"
+    parameters = [
+        ("sig_height", "Significant Wave Height", 0.1),
+        ("sig_period", "Significant Wave Period", 1.0),
+        ("scale_ratio", "Scale Ratio", 1.0),
+        ("gamma", "Gamma", 3.3),
+        ("sigma_A", "Sigma A", 0.07),
+        ("sigma_B", "Sigma B", 0.09),
+    ]
+
+    def _spectrum(
+        self, f, sig_height, sig_period, scale_ratio, gamma, sigma_A, sigma_B
+    ):
+        sigma = np.where(f <= 1.0 / sig_period, sigma_A, sigma_B)
+        alpha = 0.0624 / (
+            0.230 + 0.0336 * gamma - 0.185 * (1.9 + gamma) ** (-1)
+        )
+        A = np.exp((-((f * sig_period - 1.0) ** 2)) / (2 * sigma**2))
+        B = -1.25 * (sig_period * f) ** (-4)
+        return (
+            alpha
+            * sig_height**2
+            * sig_period ** (-4)
+            * f ** (-5)
+            * np.exp(B)
+            * gamma**A
+        )
+
+    def characteristic(self, sig_height, sig_period, **params):
+        return sig_height, sig_period  # Don't know about height...
+
+
+@register_spectrum
+class PiersonMoskowitz(Spectrum):
+    """Needs implementation of scale ratio, or not."""
+
+    name = "Pierson-Moskowitz"
+    parameters = [
+        ("windspeed", "Wind Speed", 2.0),
+        ("scale_ratio", "Scale Ratio", 1.0),
+    ]
+
+    def _spectrum(self, f, windspeed, scale_ratio):
+        alpha = 8.1e-3
+        B = 0.74 * (g / (2 * pi * windspeed)) ** 4
+        return alpha * g**2 / ((2 * pi) ** 4 * f**5) * np.exp(-B / f**4)
+
+    def characteristic(self, windspeed, **params):
+        height = 0.21 * windspeed**2 / g
+        period = 2 * pi * windspeed / (0.877 * g)
+        return height, period
+
+
 class WaveTimeSeries(object):
     pass
 
@@ -138,117 +352,323 @@ class RandomWaveTimeSeries(WaveTimeSeries):
 
 
 class Wave(object):
-    """Object that mathematically represents a wave."""
+    """Object that mathematically represents a wave.
+
+    Random phases are drawn from a fresh ``np.random.Generator`` created
+    from ``seed``, which may be an int, a ``np.random.SeedSequence`` or None
+    for fresh entropy, so they depend only on the seed and the number of
+    frequencies. The seed actually used is recorded in ``seed_seq``, so the
+    same series can be regenerated by creating a wave with
+    ``seed=wave.seed_seq``.
+
+    ``gen_ts`` and the methods built on it (``gen_ts_stroke``,
+    ``gen_ts_volts`` and ``max_stroke``) make a single series that repeats:
+    one wave period for regular waves, and two minutes from one set of
+    phases for random waves. ``WaveGen`` plays that series for regular
+    waves, but for random waves it plays the ``stream_ts`` stream for the
+    seed, which ``gen_ts_batch`` and ``max_stream_stroke`` describe.
+
+    Series scale linearly with the height (or significant height) for a
+    fixed spectral shape and seed, so ``gen_ts_stroke`` scales a cached
+    unit height series from ``unit_wave`` where it can.
+
+    Each stage of the pipeline (grid, spectrum, phases, elevation, stroke,
+    volts and the peak stroke of the stream) keeps its last output and is
+    only recomputed when a parameter it depends on, or an upstream stage,
+    changes. Changing ``stroke_cal`` only rescales the volts, for example,
+    and changing the height only rescales the stream's peak stroke. Keep
+    one wave and update its attributes to benefit.
+    """
 
-    def __init__(self, wavetype):
+    def __init__(self, wavetype, seed=None):
         self.wavetype = wavetype
+        self._stages = {}
+        self.set_seed(seed)
         self.sr = 256.0
         self.buffsize = 30722  # Corresponds to 2 minutes of unique waves
         self.sbuffsize = 256  # Must be an int
+        self.water_depth = water_depth
+        self.stroke_cal = stroke_cal
         if self.wavetype == "Regular":
             self.height = 0.1
             self.period = 1.0
-        elif self.wavetype == "Bretschneider":
-            self.sig_height = 0.1
-            self.sig_period = 1.0
-            self.scale_ratio = 1.0
-        elif self.wavetype == "JONSWAP":
-            self.sig_height = 0.1
-            self.sig_period = 1.0
-            self.scale_ratio = 1.0
-            self.gamma = 3.3
-            self.sigma_A = 0.07
-            self.sigma_B = 0.09
-        elif self.wavetype == "Pierson-Moskowitz":
-            self.windspeed = 2.0
-            self.scale_ratio = 1.0
+        else:
+            for attr, value in spectra[self.wavetype].defaults().items():
+                setattr(self, attr, value)
+
+    def set_seed(self, seed=None):
+        """Reset the wave's random phases from a seed."""
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_seq = seed
+        self.phase = None
+
+    def get_phases(self, n):
+        """Returns n random phases, fixed until the wave is reseeded."""
+        # Drawn from a fresh generator each time, so a recomputed stage
+        # gives the same phases again
+        self.phase = self._stage(
+            "phases",
+            (self.seed_seq, n),
+            lambda: np.random.default_rng(self.seed_seq).normal(0, pi, n),
+        )
+        return self.phase
+
+    def height_param(self):
+        """Returns the name of the attribute the series scale linearly
+        with, or None if there is none."""
+        if self.wavetype == "Regular":
+            return "height"
+        return spectra[self.wavetype].height_param
+
+    def unit_key(self):
+        """Returns the arguments to ``unit_wave`` for this wave."""
+        name = self.height_param()
+        if self.wavetype == "Regular":
+            shape = (("period", self.period),)
+            seed = (None, ())
+            sr = None
+        else:
+            shape = tuple(
+                sorted(
+                    (attr, value)
+                    for attr, value in self.spectrum_params().items()
+                    if attr != name
+                )
+            )
+            seed = (self.seed_seq.entropy, tuple(self.seed_seq.spawn_key))
+            sr = self.sr
+        return (
+            self.wavetype,
+            shape,
+            seed,
+            sr,
+            self.buffsize,
+            self.sbuffsize,
+            self.water_depth,
+        )
+
+    def spawn(self, n):
+        """Return n copies of this wave with independent child random
+        streams, e.g. one per parallel worker."""
+        waves = []
+        for child in self.seed_seq.spawn(n):
+            wave = copy.copy(self)
+            wave._stages = dict(self._stages)
+            wave.set_seed(child)
+            waves.append(wave)
+        return waves
+
+    def spectrum_params(self):
+        """Returns a dict of the wave's spectral parameters."""
+        return {
+            attr: getattr(self, attr)
+            for attr, label, default in spectra[self.wavetype].parameters
+        }
 
     def gen_ts(self):
         if self.wavetype == "Regular":
             """Generate a regular wave time series"""
             self.sr = self.sbuffsize / self.period
-            t = np.linspace(0, 2 * pi, self.sbuffsize)
-            self.ts_elev = self.height / 2 * np.sin(t)
+            self.ts_elev = self._stage(
+                "elev",
+                (self.height, self.sbuffsize),
+                lambda: self.height
+                / 2
+                * np.sin(np.linspace(0, 2 * pi, self.sbuffsize)),
+            )
         else:
             """Generate random wave time series"""
-            nfreq = self.buffsize // 2
-            f_start = self.sr / self.buffsize
-            f_end = self.sr / 2
-            self.f = np.linspace(f_start, f_end, nfreq)
-            self.omega = 2 * pi * self.f
-
-            if self.wavetype == "Bretschneider":
-                f = self.f
-                f0 = 1 / self.sig_period
-                sig_height = self.sig_height
-                self.spec = (
-                    (5 / 16)
-                    * sig_height**2
-                    / f0
-                    / (f / f0) ** 5
-                    * np.exp(-5 / 4 * (f / f0) ** -4)
-                )
-                self.height = self.sig_height
-                self.period = self.sig_period
-
-            elif self.wavetype == "JONSWAP":
-                """Compute a JONSWAP spectrum"""
-                i_left = np.where(self.f <= 1.0 / self.sig_period)[0]
-                i_right = np.where(self.f > 1.0 / self.sig_period)[0]
-                sigma = np.zeros(len(self.f))
-                sigma[i_left] = self.sigma_A
-                sigma[i_right] = self.sigma_B
-                alpha = 0.0624 / (
-                    0.230
-                    + 0.0336 * self.gamma
-                    - 0.185 * (1.9 + self.gamma) ** (-1)
-                )
-                A = np.exp(
-                    (-((self.f * self.sig_period - 1.0) ** 2))
-                    / (2 * sigma**2)
-                )
-                B = -1.25 * (self.sig_period * self.f) ** (-4)
-                self.spec = (
-                    alpha
-                    * self.sig_height**2
-                    * self.sig_period ** (-4)
-                    * self.f ** (-5)
-                    * np.exp(B)
-                    * self.gamma**A
-                )
-                self.period = self.sig_period
-                self.height = self.sig_height  # Don't know about this...
-
-            elif self.wavetype == "Pierson-Moskowitz":
-                """Needs implementation of scale ratio, or not."""
-                U = self.windspeed
-                alpha = 8.1e-3
-                f = self.f
-                B = 0.74 * (g / (2 * pi * U)) ** 4
-                self.spec = (
-                    alpha
-                    * g**2
-                    / ((2 * pi) ** 4 * f**5)
-                    * np.exp(-B / f**4)
-                )
-                self.height = 0.21 * self.windspeed**2 / g
-                self.period = 2 * pi * self.windspeed / (0.877 * g)
+            self.gen_spec()
             # Final step: compute time series
-            self.ts_elev = spec2ts(self.spec, self.sr)
+            phase = self.get_phases(len(self.spec))
+            self.ts_elev = self._stage(
+                "elev",
+                (self.spec, phase, self.sr),
+                lambda: phases2ts(self.spec, self.sr, phase),
+            )
+
+    def gen_spec(self):
+        """Compute the frequency grid and spectrum for random waves."""
+        self.f = self._stage(
+            "grid",
+            (self.sr, self.buffsize),
+            lambda: np.linspace(
+                self.sr / self.buffsize, self.sr / 2, self.buffsize // 2
+            ),
+        )
+        self.omega = 2 * pi * self.f
+        spectrum = spectra[self.wavetype]
+        params = self.spectrum_params()
+        self.spec = self._stage(
+            "spectrum",
+            (self.f, self.wavetype, tuple(sorted(params.items()))),
+            lambda: spectrum.evaluate(self.f, **params)[0],
+        )
+        self.height, self.period = spectrum.characteristic(**params)
 
     def gen_ts_stroke(self):
-        """Needs algorithm for random waves"""
+        """Generate elevation and stroke time series.
+
+        If the wave has a height parameter, the cached unit height series
+        are scaled by it instead of rerunning the pipeline.
+        """
+        name = self.height_param()
+        if name is None:
+            self.gen_ts_stroke_full()
+            return
+        h = getattr(self, name)
+        unit = unit_wave(*self.unit_key())
+        self.sr = unit.sr
+        if self.wavetype != "Regular":
+            self.f, self.omega = unit.f, unit.omega
+            self.spec = self._stage(
+                "spectrum", (unit.spec, h), lambda: h**2 * unit.spec
+            )
+        self.height = h * unit.height
+        self.period = unit.period
+        self.ts_elev = self._stage(
+            "elev", (unit.ts_elev, h), lambda: h * unit.ts_elev
+        )
+        self.ts_stroke = self._stage(
+            "stroke", (unit.ts_stroke, h), lambda: h * unit.ts_stroke
+        )
+
+    def max_stroke(self):
+        """Returns the largest absolute stroke in the repeating series of
+        ``gen_ts_stroke``. For random waves this is not the series
+        ``WaveGen`` plays; see ``max_stream_stroke``."""
+        name = self.height_param()
+        if name is None:
+            self.gen_ts_stroke_full()
+            return np.abs(self.ts_stroke).max()
+        unit = unit_wave(*self.unit_key())
+        return getattr(self, name) * unit.max_stroke
+
+    def max_stream_stroke(self, duration=check_duration):
+        """Returns the largest absolute stroke in the first ``duration``
+        seconds of the series ``WaveGen`` plays: ``stream_ts`` for random
+        waves and the repeated single period for regular waves.
+
+        The unit height peak is cached, so a height change only costs a
+        multiply.
+        """
+        if self.wavetype == "Regular":
+            return self.max_stroke()
+        name = self.height_param()
+        if name is None:
+            return self._stream_peak(duration)
+        return getattr(self, name) * self._stream_peak(duration)
+
+    def _stream_peak(self, duration):
+        """Returns the largest absolute stroke in the first ``duration``
+        seconds of ``stream_ts``, at unit height if the wave has a height
+        parameter."""
+        key = (self.unit_key(), duration)
+        if self.height_param() is None:
+            return self._stage(
+                "stream peak", key, lambda: stream_max_stroke(self, duration)
+            )
+        return self._stage(
+            "stream peak", key, lambda: _unit_stream_max_stroke(*key)
+        )
+
+    def max_safe_height(
+        self, max_stroke=max_halfstroke, duration=check_duration
+    ):
+        """Returns the largest value of the height parameter for which the
+        stroke of the series ``WaveGen`` plays stays within ``max_stroke``
+        over its first ``duration`` seconds, or None if the wave has none."""
+        if self.height_param() is None:
+            return None
+        if self.wavetype == "Regular":
+            return max_stroke / unit_wave(*self.unit_key()).max_stroke
+        return max_stroke / self._stream_peak(duration)
+
+    def gen_ts_stroke_full(self):
+        """Generate elevation and stroke time series without the unit height
+        shortcut."""
         self.gen_ts()
         if self.wavetype == "Regular":
-            self.ts_stroke = elev2stroke(
-                self.ts_elev, self.height, self.period
+            self.ts_stroke = self._stage(
+                "stroke",
+                (self.ts_elev, self.height, self.period, self.water_depth),
+                lambda: elev2stroke(
+                    self.ts_elev, self.height, self.period, self.water_depth
+                ),
             )
         else:
-            self.ts_stroke = elev2stroke2(self.ts_elev, self.sr)
+            self.ts_stroke = self._stage(
+                "stroke",
+                (self.ts_elev, self.sr, self.water_depth),
+                lambda: elev2stroke2(self.ts_elev, self.sr, self.water_depth),
+            )
 
     def gen_ts_volts(self):
         self.gen_ts_stroke()
-        self.ts_volts = stroke2volts(self.ts_stroke)
+        self.ts_volts = self._stage(
+            "volts",
+            (self.ts_stroke, self.stroke_cal),
+            lambda: self.ts_stroke * self.stroke_cal,
+        )
+
+    def _stage(self, name, key, compute):
+        """Returns the output of pipeline stage ``name``, calling ``compute``
+        only if ``key`` differs from the key it was last computed with.
+
+        Keys hold the parameters a stage depends on and the outputs of the
+        stages upstream of it. Arrays are compared by identity, so a stage
+        is invalidated whenever an upstream stage is recomputed. Outputs are
+        shared between calls and must not be modified in place.
+        """
+        entry = self._stages.get(name)
+        if entry is None or not _same_key(entry[0], key):
+            entry = (key, compute())
+            self._stages[name] = entry
+        return entry[1]
+
+    def gen_ts_batch(
+        self, seeds, output="elev", chunk_size=16, duration=120.0
+    ):
+        """Generate many random wave realizations of the same spectrum.
+
+        ``seeds`` is a list of seeds, one per realization, or a count n
+        meaning seeds 0 to n - 1. Each row is the first ``duration`` seconds
+        of ``stream_ts`` for a wave with that seed, i.e. what ``WaveGen``
+        plays for it, so seeds can be screened here and then played. The
+        frames are synthesized with the same phases in the same order, but
+        ``chunk_size`` realizations at a time with batched FFTs to bound
+        temporary memory. ``output`` is one of "elev", "stroke" or "volts".
+        Returns an array with one realization per row.
+        """
+        if self.wavetype == "Regular":
+            raise ValueError("Regular waves have no random phases")
+        if output not in ("elev", "stroke", "volts"):
+            raise ValueError("Unknown output: " + str(output))
+        if isinstance(seeds, int):
+            seeds = range(seeds)
+        seeds = list(seeds)
+        frame_size = stream_frame_size
+        hop = frame_size // 2
+        amp, window = _stream_frames(self, frame_size, output)
+        n = int(round(duration * self.sr))
+        nframes = -(-n // hop)
+        out = np.empty((len(seeds), n))
+        for i in range(0, len(seeds), chunk_size):
+            chunk = seeds[i : i + chunk_size]
+            phases = np.array(
+                [
+                    np.random.default_rng(s).normal(0, pi, (nframes, len(amp)))
+                    for s in chunk
+                ]
+            )
+            frames = np.fft.irfft(amp * np.exp(1j * phases), frame_size)
+            frames *= window
+            # Overlap-add each frame's second half onto the next one's first
+            ts = frames[..., :hop]
+            ts[:, 1:] += frames[:, :-1, hop:]
+            out[i : i + len(chunk)] = ts.reshape(len(chunk), -1)[:, :n]
+        return out
 
     def comp_spec(self):
         t = np.arange(len(self.ts_elev)) / self.sr
@@ -256,6 +676,59 @@ class Wave(object):
         return f, spec
 
 
+def _same_key(a, b):
+    """Returns True if two pipeline stage keys match."""
+    return len(a) == len(b) and all(
+        x is y or (not isinstance(x, np.ndarray) and x == y)
+        for x, y in zip(a, b)
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def unit_wave(wavetype, shape, seed, sr, buffsize, sbuffsize, depth):
+    """Returns a wave with unit height parameter and its series generated.
+
+    The arguments are those returned by ``Wave.unit_key``. Results are kept
+    in a bounded LRU cache and their arrays are read-only, so they can be
+    shared between threads. ``max_stroke`` holds the largest absolute
+    stroke.
+    """
+    entropy, spawn_key = seed
+    seed = np.random.SeedSequence(entropy, spawn_key=spawn_key)
+    wave = Wave(wavetype, seed=seed)
+    if sr is not None:
+        wave.sr = sr
+    wave.buffsize = buffsize
+    wave.sbuffsize = sbuffsize
+    wave.water_depth = depth
+    for attr, value in shape:
+        setattr(wave, attr, value)
+    setattr(wave, wave.height_param(), 1.0)
+    wave.gen_ts_stroke_full()
+    wave.max_stroke = np.abs(wave.ts_stroke).max()
+    for attr in ("f", "omega", "spec", "ts_elev", "ts_stroke"):
+        if hasattr(wave, attr):
+            getattr(wave, attr).flags.writeable = False
+    return wave
+
+
+def stream_max_stroke(wave, duration, block_size=65536):
+    """Returns the largest absolute stroke in the first ``duration`` seconds
+    of ``stream_ts`` for a random wave."""
+    n = int(round(duration * wave.sr))
+    stream = stream_ts(wave, block_size, output="stroke")
+    peak = 0.0
+    for i in range(0, n, block_size):
+        block = next(stream)[: n - i]
+        peak = max(peak, np.abs(block).max())
+    return peak
+
+
+@functools.lru_cache(maxsize=8)
+def _unit_stream_max_stroke(key, duration):
+    return stream_max_stroke(unit_wave(*key), duration)
+
+
 def ramp_ts(ts, direction):
     rampfull = np.ones(len(ts))
     ramp = np.hanning(len(ts))
@@ -266,6 +739,236 @@ def ramp_ts(ts, direction):
     return ts * rampfull
 
 
+def _stream_frames(wave, frame_size, output):
+    """Returns the spectral amplitudes and the window of ``stream_ts``
+    frames."""
+    sr = wave.sr
+    nbins = frame_size // 2 + 1
+    f = np.arange(1, nbins) * sr / frame_size
+    spec = spectra[wave.wavetype].evaluate(f, **wave.spectrum_params())[0]
+    # Scale so each frame has the spectrum's variance
+    amp = np.zeros(nbins)
+    amp[1:] = frame_size * np.sqrt(spec * sr / frame_size / 2)
+    if output != "elev":
+        amp *= band_stroke_gain(
+            frame_size, float(sr), float(wave.water_depth), paddle_height
+        )
+    if output == "volts":
+        amp *= wave.stroke_cal
+    window = np.sin(pi * (np.arange(frame_size) + 0.5) / frame_size)
+    return amp, window
+
+
+def stream_ts(
+    wave, block_size=256, frame_size=stream_frame_size, output="volts"
+):
+    """Generate a random wave time series indefinitely, in blocks.
+
+    This is the series ``WaveGen`` plays for random waves, and that
+    ``gen_ts_files``, ``build_library`` and ``Wave.gen_ts_batch`` produce.
+    Frames of ``frame_size`` samples, each with new random phases, are
+    synthesized from the wave's spectrum, tapered with a sine window and
+    overlap-added at 50 % so the summed variance is constant. The series is
+    therefore stationary, has no repeat period and uses constant memory.
+    Phases come from a generator seeded with ``wave.seed_seq``, so streams
+    of different outputs for the same wave are consistent. ``output`` is one
+    of "elev", "stroke" or "volts". Yields arrays of ``block_size`` samples.
+    """
+    if wave.wavetype == "Regular":
+        raise ValueError("Regular waves are not streamed")
+    rng = np.random.default_rng(wave.seed_seq)
+    hop = frame_size // 2
+    nbins = frame_size // 2 + 1
+    amp, window = _stream_frames(wave, frame_size, output)
+    tail = np.zeros(hop)
+    pending = np.zeros(0)
+    while True:
+        phase = rng.normal(0, pi, nbins)
+        frame = np.fft.irfft(amp * np.exp(1j * phase), frame_size) * window
+        frame[:hop] += tail
+        tail = frame[hop:]
+        pending = np.concatenate([pending, frame[:hop]])
+        while len(pending) >= block_size:
+            yield pending[:block_size]
+            pending = pending[block_size:]
+
+
+ts_outputs = ("elev", "stroke", "volts")
+
+
+def gen_ts_files(wave, path, duration, chunk_size=65536):
+    """Generate long random wave series out of core.
+
+    Elevation, stroke and volt series lasting ``duration`` seconds are
+    streamed with ``stream_ts`` into memory-mapped ``elev.npy``,
+    ``stroke.npy`` and ``volts.npy`` in directory ``path``, ``chunk_size``
+    samples at a time, so resident memory does not grow with duration. The
+    wave's parameters and seed are saved in ``wave.json``. Returns the
+    result of ``load_ts_files``.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    n = int(round(duration * wave.sr))
+    for output in ts_outputs:
+        ts = np.lib.format.open_memmap(
+            os.path.join(path, output + ".npy"), mode="w+", shape=(n,)
+        )
+        stream = stream_ts(wave, chunk_size, output=output)
+        for i in range(0, n, chunk_size):
+            ts[i : i + chunk_size] = next(stream)[: n - i]
+            ts.flush()
+        del ts
+    meta = {
+        "wavetype": wave.wavetype,
+        "params": wave.spectrum_params(),
+        "sr": wave.sr,
+        "water_depth": wave.water_depth,
+        "stroke_cal": wave.stroke_cal,
+        "entropy": wave.seed_seq.entropy,
+        "spawn_key": list(wave.seed_seq.spawn_key),
+        "n_samples": n,
+    }
+    with open(os.path.join(path, "wave.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+    return load_ts_files(path)
+
+
+def load_ts_files(path):
+    """Load series written by ``gen_ts_files``.
+
+    Returns the Wave they were generated from and a dict of read-only
+    memory-mapped arrays keyed by "elev", "stroke" and "volts". Raises
+    ValueError if the volts were generated with a different stroke
+    calibration.
+    """
+    with open(os.path.join(path, "wave.json")) as f:
+        meta = json.load(f)
+    if meta.get("stroke_cal") != stroke_cal:
+        raise ValueError(
+            "Series in {} were generated with a different stroke "
+            "calibration".format(path)
+        )
+    seed = np.random.SeedSequence(
+        meta["entropy"], spawn_key=meta["spawn_key"]
+    )
+    wave = Wave(meta["wavetype"], seed=seed)
+    wave.sr = meta["sr"]
+    wave.water_depth = meta["water_depth"]
+    for attr, value in meta["params"].items():
+        setattr(wave, attr, value)
+    ts = {
+        output: np.load(os.path.join(path, output + ".npy"), mmap_mode="r")
+        for output in ts_outputs
+    }
+    return wave, ts
+
+
+def build_library(path, cases, duration=120.0, chunk_size=65536):
+    """Precompute a test matrix into an HDF5 waveform library.
+
+    ``cases`` is a list of dicts with keys "name", "wavetype", "params" (a
+    dict of spectral parameters, defaults otherwise), "seed" and optionally
+    "water_depth" and "duration" (s). Each case's elevation and volt series
+    are streamed with ``stream_ts`` into chunked datasets under
+    ``/cases/<name>``. The group attributes record the wave and tank
+    constants. Each case is validated against the output voltage range and
+    ``max_halfstroke``; the result is stored in the "valid" attribute, and
+    invalid cases are reported and refused by ``load_library_case``.
+    """
+    import h5py
+
+    with h5py.File(path, "a") as f:
+        for case in cases:
+            wave = Wave(case["wavetype"], seed=case["seed"])
+            wave.water_depth = case.get("water_depth", water_depth)
+            for attr, value in case.get("params", {}).items():
+                setattr(wave, attr, value)
+            n = int(round(case.get("duration", duration) * wave.sr))
+            name = "cases/" + case["name"]
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            vmax = 0.0
+            for output in ("elev", "volts"):
+                ds = group.create_dataset(
+                    output,
+                    shape=(n,),
+                    dtype="f8",
+                    chunks=(min(chunk_size, n),),
+                )
+                stream = stream_ts(wave, chunk_size, output=output)
+                for i in range(0, n, chunk_size):
+                    block = next(stream)[: n - i]
+                    ds[i : i + len(block)] = block
+                    if output == "volts":
+                        vmax = max(vmax, np.abs(block).max())
+            max_stroke = vmax / wave.stroke_cal
+            valid = vmax <= max_volts and max_stroke <= max_halfstroke
+            if not valid:
+                print(
+                    "Case {} exceeds limits (max stroke {:.3f} m, max "
+                    "voltage {:.2f} V)".format(case["name"], max_stroke, vmax)
+                )
+            group.attrs.update(
+                {
+                    "wavetype": wave.wavetype,
+                    "params": json.dumps(wave.spectrum_params()),
+                    "entropy": str(wave.seed_seq.entropy),
+                    "spawn_key": json.dumps(list(wave.seed_seq.spawn_key)),
+                    "sr": wave.sr,
+                    "water_depth": wave.water_depth,
+                    "paddle_height": paddle_height,
+                    "stroke_cal": wave.stroke_cal,
+                    "max_halfstroke": max_halfstroke,
+                    "n_samples": n,
+                    "max_stroke": max_stroke,
+                    "max_volts": vmax,
+                    "valid": valid,
+                }
+            )
+
+
+def load_library_case(path, name):
+    """Open one case of an HDF5 waveform library.
+
+    Returns the Wave it was generated from and a dict of the "elev" and
+    "volts" datasets, which are read from disk as they are sliced. The file
+    stays open until closed with ``close_library_case``. Raises ValueError
+    for cases that failed validation or were built with a different stroke
+    calibration.
+    """
+    import h5py
+
+    f = h5py.File(path, "r")
+    group = f["cases/" + name]
+    attrs = group.attrs
+    error = None
+    if not attrs["valid"]:
+        error = "Library case {} exceeds limits".format(name)
+    elif attrs["stroke_cal"] != stroke_cal:
+        error = (
+            "Library case {} was built with a different stroke "
+            "calibration".format(name)
+        )
+    if error is not None:
+        f.close()
+        raise ValueError(error)
+    seed = np.random.SeedSequence(
+        int(attrs["entropy"]), spawn_key=json.loads(attrs["spawn_key"])
+    )
+    wave = Wave(str(attrs["wavetype"]), seed=seed)
+    wave.sr = float(attrs["sr"])
+    wave.water_depth = float(attrs["water_depth"])
+    for attr, value in json.loads(attrs["params"]).items():
+        setattr(wave, attr, value)
+    return wave, {"elev": group["elev"], "volts": group["volts"]}
+
+
+def close_library_case(ts):
+    """Close the file of the datasets returned by ``load_library_case``."""
+    ts["volts"].file.close()
+
+
 if __name__ == "__main__":
     import matplotlib.pyplot as plt
     #    wave = Wave("JONSWAP")